@@ -0,0 +1,248 @@
+# Approximate nearest-neighbour index over intermediate-domain embeddings (gallery_feature of Gen_p2s_A_)
+# IVF: k-means coarse lists, a query scans only its nprobe nearest lists; optional PQ codes of the residuals
+# (PQ: pq_m bytes per vector instead of 4 * D, scores are approximate, so recall saturates below exact IVF)
+# similarity is the inner product of L2-normalized rows, as in search.topk_blocked (exact search)
+#   python ann.py --features record/step0/gallery_cache/<key>/features.npy --nlist 256 --nprobe 1,4,16,64
+#   python ann.py --num 100000 --dim 256 --pq_m 32   (synthetic clustered embeddings)
+import json
+import time
+import argparse
+import numpy as np
+
+import search
+
+
+def nearest_centroids(data, centroids, num=1, block=8192):
+    # [N, num] indices of the most similar centroids (inner product)
+    result = np.empty([len(data), num], dtype=np.int64)
+    for start in range(0, len(data), block):
+        scores = np.dot(np.asarray(data[start:start + block], dtype=np.float32), centroids.T)
+        if num == 1:
+            result[start:start + len(scores), 0] = scores.argmax(axis=1)
+        else:
+            part = np.argpartition(-scores, num - 1, axis=1)[:, 0:num]
+            order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+            result[start:start + len(scores)] = np.take_along_axis(part, order, axis=1)
+    return result
+
+
+def kmeans(data, num_clusters, iterations=20, seed=0, spherical=True):
+    # Lloyd iterations on data [N, D] (a sample is enough); spherical: unit-norm centroids (cosine)
+    rng = np.random.RandomState(seed)
+    num_clusters = min(num_clusters, len(data))
+    centroids = np.array(data[rng.choice(len(data), num_clusters, replace=False)], dtype=np.float32)
+    for _ in range(iterations):
+        if spherical:
+            assign = nearest_centroids(data, centroids)[:, 0]
+        else:
+            # squared L2: |c|^2 - 2 x.c
+            assign = nearest_centroids(np.hstack([data, -0.5 * np.ones([len(data), 1], np.float32)]),
+                                       np.hstack([centroids, np.sum(centroids**2, axis=1, keepdims=True)]))[:, 0]
+        # per-cluster sums over the rows sorted by cluster
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        used = counts > 0
+        sums[used] = np.add.reduceat(np.asarray(data, dtype=np.float32)[order], np.cumsum(counts)[used] - counts[used])
+        empty = counts == 0
+        # empty clusters restart from random points
+        sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if spherical:
+            centroids = search.normalize_rows(centroids)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex(object):
+    # nlist coarse lists; pq_m > 0 stores each vector as pq_m one-byte codes of its residual (pq_bits <= 8)
+    # rows are kept grouped by list (offsets), so a probed list is one contiguous slice
+    def __init__(self, nlist=256, pq_m=0, pq_bits=8, seed=0):
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.pq_bits = pq_bits
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None  # [pq_m, 2^pq_bits, D / pq_m]
+        self.ids = np.zeros([0], dtype=np.int64)
+        self.lists = np.zeros([0], dtype=np.int64)
+        self.data = None  # float32 [N, D] or uint8 codes [N, pq_m]
+        self.offsets = None
+
+    def train(self, data, max_samples=65536, iterations=20):
+        data = search.normalize_rows(data)
+        rng = np.random.RandomState(self.seed)
+        if len(data) > max_samples:
+            data = data[np.sort(rng.choice(len(data), max_samples, replace=False))]
+        self.centroids = kmeans(data, self.nlist, iterations, self.seed)
+        self.nlist = len(self.centroids)
+        if self.pq_m > 0:
+            assert data.shape[1] % self.pq_m == 0, 'IVFIndex: dim must be a multiple of pq_m'
+            residuals = data - self.centroids[nearest_centroids(data, self.centroids)[:, 0]]
+            sub_dim = data.shape[1] // self.pq_m
+            self.codebooks = np.stack([kmeans(residuals[:, m * sub_dim:(m + 1) * sub_dim], 2**self.pq_bits,
+                                              iterations, self.seed + m, spherical=False)
+                                       for m in range(self.pq_m)])
+        return self
+
+    def encode(self, residuals):
+        sub_dim = residuals.shape[1] // self.pq_m
+        codes = np.empty([len(residuals), self.pq_m], dtype=np.uint8)
+        for m in range(self.pq_m):
+            codebook = self.codebooks[m]
+            sub = residuals[:, m * sub_dim:(m + 1) * sub_dim]
+            codes[:, m] = nearest_centroids(np.hstack([sub, -0.5 * np.ones([len(sub), 1], np.float32)]),
+                                            np.hstack([codebook, np.sum(codebook**2, axis=1, keepdims=True)]))[:, 0]
+        return codes
+
+    def add(self, data, ids=None, block=65536):
+        assert self.centroids is not None, 'IVFIndex: train before add'
+        if ids is None:
+            ids = np.arange(len(self.ids), len(self.ids) + len(data), dtype=np.int64)
+        lists = []
+        rows = []
+        for start in range(0, len(data), block):
+            chunk = search.normalize_rows(data[start:start + block])
+            assign = nearest_centroids(chunk, self.centroids)[:, 0]
+            lists.append(assign)
+            rows.append(self.encode(chunk - self.centroids[assign]) if self.pq_m > 0 else chunk)
+        new_rows = np.concatenate(rows)
+        all_rows = new_rows if self.data is None else np.concatenate([self.data, new_rows])
+        all_lists = np.concatenate([self.lists] + lists)
+        all_ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        order = np.argsort(all_lists, kind='stable')
+        self.data, self.lists, self.ids = all_rows[order], all_lists[order], all_ids[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength=self.nlist))])
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=10, nprobe=8):
+        # (ids, scores) [num_queries, k], best first; -1 / -inf where fewer than k candidates were scanned
+        queries = search.normalize_rows(queries)
+        probes = nearest_centroids(queries, self.centroids, min(nprobe, self.nlist))
+        result_ids = np.full([len(queries), k], -1, dtype=np.int64)
+        result_scores = np.full([len(queries), k], -np.inf, dtype=np.float32)
+        if self.pq_m > 0:
+            sub_dim = queries.shape[1] // self.pq_m
+            table_offsets = np.arange(self.pq_m) * self.codebooks.shape[1]
+        for q, query in enumerate(queries):
+            scores = []
+            ids = []
+            if self.pq_m > 0:
+                # query . (centroid + residual), residual part from per-subspace lookup tables
+                tables = np.einsum('mcd,md->mc', self.codebooks, query.reshape(self.pq_m, sub_dim)).ravel()
+            for l in probes[q]:
+                start, end = self.offsets[l], self.offsets[l + 1]
+                if start == end:
+                    continue
+                if self.pq_m > 0:
+                    codes = self.data[start:end]
+                    scores.append(np.dot(self.centroids[l], query)
+                                  + np.take(tables, codes + table_offsets).sum(axis=1))
+                else:
+                    scores.append(np.dot(self.data[start:end], query))
+                ids.append(self.ids[start:end])
+            if not scores:
+                continue
+            scores = np.concatenate(scores)
+            ids = np.concatenate(ids)
+            num = min(k, len(scores))
+            top = np.argpartition(-scores, num - 1)[0:num]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            result_ids[q, 0:num] = ids[top]
+            result_scores[q, 0:num] = scores[top]
+        return result_ids, result_scores
+
+    def save(self, path):
+        # written through a file object, np.savez would append .npz to a bare path
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids,
+                     codebooks=self.codebooks if self.codebooks is not None else np.zeros(0),
+                     data=self.data, lists=self.lists, ids=self.ids, offsets=self.offsets,
+                     params=np.array([self.nlist, self.pq_m, self.pq_bits, self.seed]))
+        return path
+
+    @classmethod
+    def load(cls, path):
+        values = np.load(path)
+        nlist, pq_m, pq_bits, seed = [int(v) for v in values['params']]
+        index = cls(nlist, pq_m, pq_bits, seed)
+        index.centroids = values['centroids']
+        index.codebooks = values['codebooks'] if pq_m > 0 else None
+        index.data = values['data']
+        index.lists = values['lists']
+        index.ids = values['ids']
+        index.offsets = values['offsets']
+        return index
+
+
+def synthetic_embeddings(num, dim, num_identities=1000, noise=0.5, seed=0):
+    # clustered unit vectors standing in for gallery features
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(0, 1, [num_identities, dim]).astype(np.float32)
+    data = centers[rng.randint(0, num_identities, num)] + noise * rng.normal(0, 1, [num, dim]).astype(np.float32)
+    return search.normalize_rows(data)
+
+
+def recall_latency(config):
+    # recall@k of the index against exact search, and ms per query, for each nprobe
+    if config.features:
+        data = np.load(config.features, mmap_mode='r')
+    else:
+        data = synthetic_embeddings(config.num, config.dim, seed=config.seed)
+    rng = np.random.RandomState(config.seed + 1)
+    queries = search.normalize_rows(data[np.sort(rng.choice(len(data), config.num_queries, replace=False))])
+    queries = search.normalize_rows(queries + config.query_noise * rng.normal(0, 1, queries.shape) / np.sqrt(
+        queries.shape[1]))
+
+    start_time = time.time()
+    exact, _ = search.topk_blocked(queries, data, config.k, normalize_gallery=True)
+    exact_ms = 1000 * (time.time() - start_time) / len(queries)
+
+    start_time = time.time()
+    index = IVFIndex(config.nlist, config.pq_m, config.pq_bits, config.seed).train(data).add(data)
+    build_sec = time.time() - start_time
+    if config.index_path:
+        index.save(config.index_path)
+        index = IVFIndex.load(config.index_path)
+
+    print('%d x %d embeddings, %d queries, nlist %d, pq_m %d: build %.1f sec, exact %.2f ms/query'
+          % (len(data), data.shape[1], len(queries), index.nlist, config.pq_m, build_sec, exact_ms))
+    results = []
+    for nprobe in [int(n) for n in config.nprobe.split(',')]:
+        start_time = time.time()
+        ids, _ = index.search(queries, config.k, nprobe)
+        ann_ms = 1000 * (time.time() - start_time) / len(queries)
+        recall = np.mean([len(np.intersect1d(ids[q], exact[q])) / float(config.k) for q in range(len(queries))])
+        results.append({'nprobe': nprobe, 'recall': float(recall), 'ms_per_query': ann_ms,
+                        'speedup': exact_ms / ann_ms})
+        print('nprobe %4d: recall@%d %.4f, %.3f ms/query (%.1fx exact)' % (nprobe, config.k, recall, ann_ms,
+                                                                            exact_ms / ann_ms))
+    if config.out_json:
+        with open(config.out_json, 'w') as f:
+            json.dump({'num': len(data), 'dim': int(data.shape[1]), 'nlist': index.nlist, 'pq_m': config.pq_m,
+                       'k': config.k, 'build_sec': build_sec, 'exact_ms_per_query': exact_ms, 'results': results},
+                      f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', type=str, default=None)  # .npy [N, D], e.g. a gallery cache features.npy
+    parser.add_argument('--num', type=int, default=100000)  # synthetic embeddings when no --features
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--num_queries', type=int, default=500)
+    parser.add_argument('--query_noise', type=float, default=0.5)
+    parser.add_argument('--nlist', type=int, default=256)
+    parser.add_argument('--nprobe', type=str, default='1,4,16,64')
+    parser.add_argument('--pq_m', type=int, default=0)  # 0: exact scores within the probed lists
+    parser.add_argument('--pq_bits', type=int, default=8)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--index_path', type=str, default=None)  # save and reload the index (.npz)
+    parser.add_argument('--out_json', type=str, default=None)
+    config = parser.parse_args()
+
+    recall_latency(config)
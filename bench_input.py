@@ -0,0 +1,172 @@
+# Input pipeline micro-benchmarks (CPU)
+#   --mode augment: per-example preprocess() crop/flip vs. batched augment_pair_batch()
+#   --mode pipeline: photo_sketch_batch_inputs alone on a synthetic png db, across thread counts and queue capacities
+#     python bench_input.py --mode pipeline --threads 1,2,4 --capacities 4,16 --out_json bench_input.json
+import os
+import json
+import time
+import tempfile
+import argparse
+import numpy as np
+import tensorflow as tf
+
+import input_data
+from utils import write_synthetic_db
+
+
+def time_op(sess, op, iterations, warmup=5):
+    for _ in range(warmup):
+        sess.run(op)
+    start_time = time.time()
+    for _ in range(iterations):
+        sess.run(op)
+    return (time.time() - start_time) / iterations
+
+
+def bench_augment(config):
+    tf.reset_default_graph()
+    shape = [config.batch_size, config.img_size, config.img_size, config.channels]
+    photo_u8 = tf.Variable(np.random.randint(0, 256, shape).astype(np.uint8), trainable=False)
+    sketch_u8 = tf.Variable(np.random.randint(0, 256, shape).astype(np.uint8), trainable=False)
+
+    # current path: preprocess() per example, photo and sketch separately with a shared seed
+    photos = []
+    sketches = []
+    for b in range(config.batch_size):
+        seed = np.random.randint(0, 2**31 - 1)
+        photos.append(input_data.preprocess(photo_u8[b], config.img_size, config.channels, True, config.crop_size,
+                                            True, config.padding_size, seed=seed))
+        sketches.append(input_data.preprocess(sketch_u8[b], config.img_size, config.channels, True, config.crop_size,
+                                              True, config.padding_size, seed=seed))
+    per_example = tf.group(tf.stack(photos), tf.stack(sketches))
+
+    # batched path: normalize/pad the batch, then one fused crop/flip
+    photo = tf.divide(tf.subtract(tf.to_float(photo_u8), 127.5), 127.5)
+    sketch = tf.divide(tf.subtract(tf.to_float(sketch_u8), 127.5), 127.5)
+    if config.padding_size != config.img_size:
+        photo = tf.image.resize_image_with_crop_or_pad(photo, config.padding_size, config.padding_size)
+        sketch = tf.image.resize_image_with_crop_or_pad(sketch, config.padding_size, config.padding_size)
+    # alignment check: the same batch given as photo and sketch must come out identical
+    check_a, check_b = input_data.augment_pair_batch(photo, photo, config.crop_size, flip=True, random_crop=True)
+    aligned = tf.reduce_all(tf.equal(check_a, check_b))
+    photo, sketch = input_data.augment_pair_batch(photo, sketch, config.crop_size, flip=True, random_crop=True)
+    batched = tf.group(photo, sketch)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        assert sess.run(aligned), 'augment_pair_batch: photo/sketch misaligned'
+        t_example = time_op(sess, per_example, config.iterations)
+        t_batch = time_op(sess, batched, config.iterations)
+
+    results = [('per_example', t_example), ('batched', t_batch)]
+    for name, t in results:
+        print('augment %-12s batch %d: %.3f ms/batch, %.1f pairs/sec'
+              % (name, config.batch_size, t * 1000, config.batch_size / t))
+    print('speedup: %.2fx' % (t_example / t_batch))
+    return results
+
+
+def bench_stages(config, filedir):
+    # per-image cost of decode and preprocess (one thread, no queues); batching is what the pipeline adds on top
+    tf.reset_default_graph()
+    with tf.device('/cpu:0'):
+        decoded = tf.image.decode_image(tf.read_file(filedir), channels=config.channels)
+        decoded.set_shape([config.img_size, config.img_size, config.channels])
+        processed = input_data.preprocess(decoded, config.img_size, config.channels, True, config.crop_size, True,
+                                          config.padding_size)
+    with tf.Session() as sess:
+        t_decode = time_op(sess, decoded.op, config.iterations)
+        t_processed = time_op(sess, processed.op, config.iterations)
+    return {'decode_ms': 1000 * t_decode, 'preprocess_ms': 1000 * max(t_processed - t_decode, 0.0)}
+
+
+def synthetic_db(config):
+    # one synthetic db per image size, channels and number of images under db_dir, never reused across settings
+    db_dir = config.db_dir + '/%dpx_%dch_%d' % (config.img_size, config.channels, config.num_images)
+    if not os.path.exists(db_dir + '/tr_list.txt'):
+        write_synthetic_db(db_dir, num_images=config.num_images, img_size=config.img_size, channel=config.channels)
+    return db_dir
+
+
+def bench_pipeline_setting(config, db_dir, num_threads, capacity):
+    # photo/sketch pairs/sec and queue occupancy of the training input graph (train_gan settings of GAN.build_trainer)
+    tf.reset_default_graph()
+    list_txt = db_dir + '/tr_list.txt'
+    batch = input_data.photo_sketch_batch_inputs(db_dir, list_txt, list_txt, None, 1, ['real_db'],
+                                                 config.batch_size, config.img_size, 'bench_', config.channels,
+                                                 config.channels, flip=True, crop_size=config.crop_size,
+                                                 padding_size=config.padding_size, random_crop=True,
+                                                 train_mode='train_gan', concat_sketch_styles=True,
+                                                 num_threads=num_threads, queue_capacity=capacity * config.batch_size)
+    queues = [qr.queue for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)]
+    fetches = {'batch': batch[0:2], 'queue_sizes': [q.size() for q in queues]}
+    with tf.Session() as sess:
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+        for _ in range(config.warmup):
+            sess.run(fetches)
+        # occupancy sampled at every dequeue: (seconds since start, size of each queue)
+        occupancy = []
+        start_time = time.time()
+        for _ in range(config.iterations):
+            result = sess.run(fetches)
+            occupancy.append([time.time() - start_time] + [int(size) for size in result['queue_sizes']])
+        elapsed = time.time() - start_time
+        coord.request_stop()
+        coord.join(threads)
+    occupancy = np.array(occupancy)
+    fill = occupancy[:, 1:].mean(axis=0)
+    return {'num_threads': num_threads, 'capacity': capacity * config.batch_size,
+            'pairs_per_sec': config.iterations * config.batch_size / elapsed,
+            'batch_ms': 1000 * elapsed / config.iterations, 'queue_names': [q.name for q in queues],
+            'queue_fill': fill.tolist(), 'occupancy': occupancy.tolist()}
+
+
+def bench_pipeline(config):
+    db_dir = synthetic_db(config)
+    stages = bench_stages(config, db_dir + '/photo/00000.png')
+    results = []
+    for num_threads in [int(t) for t in config.threads.split(',')]:
+        for capacity in [int(c) for c in config.capacities.split(',')]:
+            result = bench_pipeline_setting(config, db_dir, num_threads, capacity)
+            # per photo/sketch pair: decode and preprocess of both images, the rest is queueing and batching
+            pair_ms = 1000.0 / result['pairs_per_sec']
+            stage_ms = 2 * (stages['decode_ms'] + stages['preprocess_ms'])
+            result.update({'decode_ms': 2 * stages['decode_ms'], 'preprocess_ms': 2 * stages['preprocess_ms'],
+                           'batch_overhead_ms': max(num_threads * pair_ms - stage_ms, 0.0)})
+            results.append(result)
+            print('threads %d capacity %3d: %.1f pairs/sec, %.1f ms/batch, queue fill %s'
+                  % (num_threads, result['capacity'], result['pairs_per_sec'], result['batch_ms'],
+                     ', '.join('%s %.1f' % (n, f) for n, f in zip(result['queue_names'], result['queue_fill']))))
+            print('%24s per pair and thread: decode %.2f ms, preprocess %.2f ms, queue/batch %.2f ms'
+                  % ('', result['decode_ms'], result['preprocess_ms'], result['batch_overhead_ms']))
+    if config.out_json:
+        with open(config.out_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default='augment')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--img_size', type=int, default=272)
+    parser.add_argument('--padding_size', type=int, default=272)
+    parser.add_argument('--crop_size', type=int, default=256)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=50)
+    # pipeline mode
+    parser.add_argument('--db_dir', type=str, default=tempfile.gettempdir() + '/bench_input_db')
+    parser.add_argument('--num_images', type=int, default=64)
+    parser.add_argument('--threads', type=str, default='1,2,4')
+    parser.add_argument('--capacities', type=str, default='4,16')  # queue capacity in batches (train_gan: 16)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--out_json', type=str, default=None)
+    config = parser.parse_args()
+
+    if config.mode == 'augment':
+        bench_augment(config)
+    elif config.mode == 'pipeline':
+        bench_pipeline(config)
+    else:
+        assert False, 'Wrong bench mode'
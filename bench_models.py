@@ -0,0 +1,224 @@
+# Per-model benchmarks: parameters, FLOPs, forward / forward+backward time and peak memory of config_network models
+#   python bench_models.py --compare models --batch_size 1 --crop_size 256 --out_json bench_models.json
+#   python bench_models.py --models col_gen_enc,col_gen_dec,col_gen --compare recompute
+#   python bench_models.py --compare adain --batch_size 4 --crop_size 256   (AdaIN_p2s_s2p_new vs. AdaIN_fused)
+# each (model, setting) runs in its own process, so peak memory belongs to that configuration only
+# --out_json records the git commit and settings with the results, to track them across commits
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+import gan_share
+import model
+from utils import peak_rss_mb
+
+ADAIN_FUNCS = {'composed': model.AdaIN_p2s_s2p_new, 'fused': model.AdaIN_fused}
+# one key per config_network model (aliases left out)
+MODEL_KEYS = ['pix2pix', 'col_gen', 'res4', 'col_gen_enc', 'col_gen_dec', 'col_gen_old', 'res4_old', 'patchgan']
+
+
+def model_io(model_key, batch_size, crop_size, img_channels=3, med_channels=256):
+    # (input shape, output channels) as used in GAN.build_network
+    if model_key.endswith('_dec'):
+        return [batch_size, crop_size // 4, crop_size // 4, med_channels], img_channels
+    if model_key.endswith('_enc'):
+        return [batch_size, crop_size, crop_size, img_channels], med_channels
+    if model_key.lower() == 'patchgan':
+        return [batch_size, crop_size, crop_size, 2 * img_channels], 1
+    return [batch_size, crop_size, crop_size, img_channels], img_channels
+
+
+def count_flops(graph):
+    # float operations of the graph (static shapes), as counted by tf.profiler
+    options = tf.profiler.ProfileOptionBuilder.float_operation()
+    options['output'] = 'none'
+    return tf.profiler.profile(graph, options=options).total_float_ops
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_run(sess, op, iterations, warmup=3):
+    for _ in range(warmup):
+        sess.run(op)
+    times = []
+    for _ in range(iterations):
+        start_time = time.time()
+        sess.run(op)
+        times.append(time.time() - start_time)
+    return 1000 * np.mean(times)
+
+
+def bench_model(config):
+    # one model and setting in this process
+    tf.reset_default_graph()
+    shape, output_channels = model_io(config.model, config.batch_size, config.crop_size)
+    build_func, net_config = gan_share.config_network(config.model, config.norm, output_channels=output_channels,
+                                                      output_activation=None, recompute=config.recompute)
+    inputs = tf.Variable(np.random.uniform(-1, 1, shape).astype(np.float32), trainable=False, name='bench_inputs')
+    train_mode = tf.constant(True)
+    outputs = build_func(inputs, net_config, train_mode, name='Bench_', reuse=False)
+    loss = tf.reduce_mean(outputs)
+    variables = tf.trainable_variables()
+    params = int(sum(np.prod(var.get_shape().as_list()) for var in variables))
+    forward_flops = count_flops(tf.get_default_graph())
+    backward = tf.group(*[grad for grad in tf.gradients(loss, variables + [inputs]) if grad is not None])
+    forward_backward_flops = count_flops(tf.get_default_graph())
+    try:
+        max_bytes = tf.contrib.memory_stats.MaxBytesInUse()
+    except Exception:
+        max_bytes = None
+
+    config_proto = tf.ConfigProto()
+    config_proto.gpu_options.allow_growth = True
+    config_proto.allow_soft_placement = True
+    with tf.Session(config=config_proto) as sess:
+        sess.run(tf.global_variables_initializer())
+        forward_ms = time_run(sess, outputs.op, config.iterations)
+        backward_ms = time_run(sess, backward, config.iterations)
+        allocator_mb = None
+        if max_bytes is not None:
+            try:
+                allocator_mb = sess.run(max_bytes) / float(2**20)
+            except tf.errors.OpError:
+                allocator_mb = None
+    result = {'model': config.model, 'recompute': config.recompute, 'batch_size': config.batch_size,
+              'crop_size': config.crop_size, 'norm': config.norm, 'params': params, 'forward_flops': forward_flops,
+              'forward_backward_flops': forward_backward_flops, 'forward_ms': forward_ms, 'forward_backward_ms': backward_ms,
+              'allocator_peak_mb': allocator_mb, 'peak_rss_mb': peak_rss_mb()}
+    print('RESULT ' + json.dumps(result))
+    return result
+
+
+def bench_adain(config):
+    # one AdaIN implementation in this process, on encoder-sized features (crop_size / 4, 256 channels)
+    tf.reset_default_graph()
+    shape, _ = model_io('col_gen_dec', config.batch_size, config.crop_size)
+    rng = np.random.RandomState(0)
+    content = tf.Variable(rng.normal(0, 1, shape).astype(np.float32), trainable=False, name='bench_content')
+    style = tf.Variable(rng.normal(0.5, 2, shape).astype(np.float32), trainable=False, name='bench_style')
+    outputs = ADAIN_FUNCS[config.adain](content, style)
+    # loss over every output, weighted so that no gradient term cancels
+    loss = tf.add_n([tf.reduce_sum(out * (k + 1) * tf.sin(out)) for k, out in enumerate(outputs)])
+    grads = tf.gradients(loss, [content, style])
+    check = tf.stack([tf.reduce_sum(tf.abs(out)) for out in outputs] + [tf.reduce_sum(tf.abs(g)) for g in grads])
+    try:
+        max_bytes = tf.contrib.memory_stats.MaxBytesInUse()
+    except Exception:
+        max_bytes = None
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        forward_ms = time_run(sess, tf.group(*outputs), config.iterations)
+        backward_ms = time_run(sess, tf.group(*grads), config.iterations)
+        checksums = sess.run(check).tolist()
+        allocator_mb = None
+        if max_bytes is not None:
+            try:
+                allocator_mb = sess.run(max_bytes) / float(2**20)
+            except tf.errors.OpError:
+                allocator_mb = None
+    result = {'adain': config.adain, 'batch_size': config.batch_size, 'crop_size': config.crop_size,
+              'forward_ms': forward_ms, 'forward_backward_ms': backward_ms, 'checksums': checksums,
+              'allocator_peak_mb': allocator_mb, 'peak_rss_mb': peak_rss_mb()}
+    print('RESULT ' + json.dumps(result))
+    return result
+
+
+def compare_adain(config):
+    # composed ops vs. AdaIN_fused: time, memory and agreement of the outputs and input gradients
+    results = [run_subprocess(config, None, ['--adain', name]) for name in ['composed', 'fused']]
+    base, fused = results
+    error = max(abs(a - b) / max(abs(a), 1e-6) for a, b in zip(base['checksums'], fused['checksums']))
+    print('AdaIN batch %d crop %d: fwd %.2f -> %.2f ms, fwd+bwd %.2f -> %.2f ms, peak memory %.0f -> %.0f MB, '
+          'max relative checksum difference %.2e'
+          % (config.batch_size, config.crop_size, base['forward_ms'], fused['forward_ms'],
+             base['forward_backward_ms'], fused['forward_backward_ms'], peak_memory(base), peak_memory(fused), error))
+    return results
+
+
+def run_subprocess(config, model, extra_args):
+    command = [sys.executable, os.path.abspath(__file__), '--batch_size', str(config.batch_size),
+               '--crop_size', str(config.crop_size), '--norm', config.norm, '--iterations', str(config.iterations)]
+    if model is not None:
+        command += ['--model', model]
+    output = subprocess.check_output(command + extra_args).decode('utf-8')
+    line = [l for l in output.splitlines() if l.startswith('RESULT ')][-1]
+    return json.loads(line[len('RESULT '):])
+
+
+def peak_memory(result):
+    return result['allocator_peak_mb'] if result['allocator_peak_mb'] is not None else result['peak_rss_mb']
+
+
+def compare_models(config):
+    # cost of each model key at one batch / crop size
+    results = []
+    print('%-12s %10s %10s %10s %10s %10s %10s' % ('model', 'params(M)', 'fwd GFLOP', 'f+b GFLOP', 'fwd ms', 'f+b ms',
+                                                    'peak MB'))
+    for model in config.models.split(','):
+        result = run_subprocess(config, model, ['--recompute', str(int(config.recompute))])
+        results.append(result)
+        print('%-12s %10.2f %10.2f %10.2f %10.1f %10.1f %10.0f'
+              % (model, result['params'] / 1e6, result['forward_flops'] / 1e9, result['forward_backward_flops'] / 1e9,
+                 result['forward_ms'], result['forward_backward_ms'], peak_memory(result)))
+    return results
+
+
+def compare_recompute(config):
+    # memory saved and compute added by recompute, per model key
+    results = []
+    for model in config.models.split(','):
+        base = run_subprocess(config, model, [])
+        recompute = run_subprocess(config, model, ['--recompute', '1'])
+        results += [base, recompute]
+        print('%-12s batch %d crop %d: peak memory %.0f -> %.0f MB (%.1f%% saved), fwd+bwd %.1f -> %.1f ms (%+.1f%%)'
+              % (model, config.batch_size, config.crop_size, peak_memory(base), peak_memory(recompute),
+                 100 * (1 - peak_memory(recompute) / peak_memory(base)), base['forward_backward_ms'],
+                 recompute['forward_backward_ms'],
+                 100 * (recompute['forward_backward_ms'] / base['forward_backward_ms'] - 1)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--compare', type=str, default='models')  # models, recompute, adain
+    parser.add_argument('--models', type=str, default=','.join(MODEL_KEYS))
+    parser.add_argument('--model', type=str, default=None)  # set by the compare modes: bench one model in this process
+    parser.add_argument('--recompute', type=int, default=0)
+    parser.add_argument('--adain', type=str, default=None)  # set by --compare adain: composed, fused
+    parser.add_argument('--norm', type=str, default='batch_instance')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--crop_size', type=int, default=256)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--out_json', type=str, default=None)
+    config = parser.parse_args()
+    config.recompute = bool(config.recompute)
+
+    if config.model is not None:
+        bench_model(config)
+    elif config.adain is not None:
+        bench_adain(config)
+    else:
+        if config.compare == 'models':
+            results = compare_models(config)
+        elif config.compare == 'recompute':
+            results = compare_recompute(config)
+        elif config.compare == 'adain':
+            results = compare_adain(config)
+        else:
+            assert False, 'Wrong compare mode'
+        if config.out_json:
+            record = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'compare': config.compare,
+                      'tf_version': tf.__version__, 'results': results}
+            with open(config.out_json, 'w') as f:
+                json.dump(record, f, indent=2)
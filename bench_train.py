@@ -0,0 +1,148 @@
+# Training step benchmarks on a synthetic db: step time and peak memory of GAN.build_trainer('train_gan')
+#   python bench_train.py --option mixed_precision --values none,fp16
+#   python bench_train.py --option num_replicas --values 1,2,4 --extra replica_device=cpu
+#   python bench_train.py --option accum_steps --values 1,2,4   (peak memory vs. effective batch size)
+#   python bench_train.py --option summary_mode --values none,separate,fused,scalar --summary_step 1
+#   python bench_train.py --option update_schedule --values fused,alternate --extra n_critic=1
+# each value runs in its own process (one graph, one allocator per value); bool options: '' is False
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+import options
+import gan_share
+from utils import write_synthetic_db, peak_rss_mb
+
+
+def parse_value(option, value):
+    # typed like the trainer's command line
+    return getattr(options.build_parser().parse_args(['--' + option, value]), option)
+
+
+def parse_overrides(text):
+    # 'name=value,name=value' -> {name: typed value}
+    overrides = {}
+    for item in text.split(','):
+        if item:
+            name, value = item.split('=', 1)
+            overrides[name] = parse_value(name, value)
+    return overrides
+
+
+def bench_steps(net, steps, warmup, summary_step=50):
+    try:
+        max_bytes = tf.contrib.memory_stats.MaxBytesInUse()
+    except Exception:
+        max_bytes = None
+    feed_dict = {net.train_mode: True, net.med_lambda_p: net.med_lambda}
+    # GAN.train_step, as in train_gan (summaries every summary_step)
+    net.summary_step = summary_step
+    net.build_summary()
+    fetches = {}  # train_step runs the optimizers following net.update_plan
+    with tf.Session(config=net.session_config()) as sess:
+        sess.run(tf.global_variables_initializer())
+        if net.accum_steps > 1:
+            sess.run(net.accum_zero)
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+        for i in range(warmup):
+            net.train_step(sess, i + 1, fetches, feed_dict)
+        times = []
+        for i in range(steps):
+            start_time = time.time()
+            net.train_step(sess, i + 1, fetches, feed_dict)
+            times.append(time.time() - start_time)
+        allocator_mb = None
+        if max_bytes is not None:
+            try:
+                allocator_mb = sess.run(max_bytes) / float(2**20)
+            except tf.errors.OpError:
+                # no allocator stats for this device
+                allocator_mb = None
+        coord.request_stop()
+        coord.join(threads)
+    times = np.array(times)
+    return {'step_ms': 1000 * times.mean(), 'step_p50_ms': 1000 * np.percentile(times, 50),
+            'allocator_peak_mb': allocator_mb, 'peak_rss_mb': peak_rss_mb()}
+
+
+def run_value(config):
+    # one option value in this process
+    overrides = {'d_model': 'patchgan'}  # the parser default 'PatchGan' is not a config_network key
+    overrides.update(parse_overrides(config.extra))
+    if config.option:
+        overrides[config.option] = parse_value(config.option, config.value)
+    log_dir = tempfile.mkdtemp(prefix='bench_train_')
+    gan_config = options.default_config(tr_dir=config.db_dir, ts_dir=config.db_dir, log_dir=log_dir,
+                                        batch_size=config.batch_size, **overrides)
+    tf.reset_default_graph()
+    net = gan_share.GAN(gan_config)
+    net.build_trainer(mode='train_gan')
+    result = bench_steps(net, config.steps, config.warmup, config.summary_step)
+    result.update({'option': config.option, 'value': config.value, 'batch_size': config.batch_size})
+    print('RESULT ' + json.dumps(result))
+    return result
+
+
+def run_values(config):
+    if not os.path.exists(config.db_dir + '/tr_list.txt'):
+        write_synthetic_db(config.db_dir, num_images=config.num_images)
+    results = []
+    for value in config.values.split(','):
+        batch_size = config.batch_size
+        if config.option in ['num_replicas', 'accum_steps']:
+            # batch_size per replica / per micro-batch, the update batch grows with the value
+            batch_size = config.batch_size * int(value)
+        command = [sys.executable, os.path.abspath(__file__), '--option', config.option, '--value', value,
+                   '--db_dir', config.db_dir, '--batch_size', str(batch_size), '--steps', str(config.steps),
+                   '--warmup', str(config.warmup), '--summary_step', str(config.summary_step), '--extra', config.extra]
+        output = subprocess.check_output(command).decode('utf-8')
+        line = [l for l in output.splitlines() if l.startswith('RESULT ')][-1]
+        results.append(json.loads(line[len('RESULT '):]))
+
+    base = results[0]
+    print('%s (batch %d, %d steps)' % (config.option, config.batch_size, config.steps))
+    for result in results:
+        result['images_per_sec'] = 1000 * result['batch_size'] / result['step_ms']
+        if config.option == 'num_replicas':
+            # throughput relative to num_replicas x the first value's throughput per replica
+            result['scaling_efficiency'] = (result['images_per_sec'] / int(result['value'])) / \
+                                           (base['images_per_sec'] / int(base['value']))
+        memory = result['allocator_peak_mb'] if result['allocator_peak_mb'] is not None else result['peak_rss_mb']
+        base_memory = base['allocator_peak_mb'] if base['allocator_peak_mb'] is not None else base['peak_rss_mb']
+        print('%-12s batch %d  step %.1f ms (%.2fx)  %.1f images/sec  peak memory %.0f MB (%.2fx)'
+              % (result['value'] or "''", result['batch_size'], result['step_ms'], result['step_ms'] / base['step_ms'],
+                 result['images_per_sec'], memory, memory / base_memory))
+        if 'scaling_efficiency' in result:
+            print('%-12s scaling efficiency %.2f' % ('', result['scaling_efficiency']))
+    if config.out_json:
+        with open(config.out_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--option', type=str, default='mixed_precision')
+    parser.add_argument('--values', type=str, default='none,fp16')
+    parser.add_argument('--value', type=str, default=None)  # set by run_values: bench one value in this process
+    parser.add_argument('--extra', type=str, default='')  # other trainer options, 'name=value,name=value'
+    parser.add_argument('--db_dir', type=str, default=tempfile.gettempdir() + '/bench_train_db')
+    parser.add_argument('--num_images', type=int, default=16)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--summary_step', type=int, default=50)
+    parser.add_argument('--out_json', type=str, default=None)
+    config = parser.parse_args()
+
+    if config.value is not None:
+        run_value(config)
+    else:
+        run_values(config)
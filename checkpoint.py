@@ -0,0 +1,174 @@
+# Checkpoints written off the training thread, with retention and an atomic 'latest' pointer
+# the files are plain tf.train.Saver checkpoints (<ckpt_dir>/gan-<epoch>), restorable by any Saver on the same variables
+import os
+import json
+import atexit
+import threading
+import queue
+import tensorflow as tf
+
+LATEST_FILE = 'latest.json'
+
+
+def checkpoint_path(ckpt_dir, prefix, epoch):
+    return ckpt_dir + '/' + prefix + '-' + str(epoch)
+
+
+def read_latest(ckpt_dir):
+    # {'epoch', 'path', 'kept', 'metrics'} of the last finished save, None if there is none
+    latest_file = ckpt_dir + '/' + LATEST_FILE
+    if not os.path.exists(latest_file):
+        return None
+    with open(latest_file, 'r') as f:
+        return json.load(f)
+
+
+def resolve(ckpt_dir, epoch, prefix='gan'):
+    # (epoch, checkpoint path); epoch < 0 resolves the latest checkpoint
+    if epoch >= 0:
+        return epoch, checkpoint_path(ckpt_dir, prefix, epoch)
+    latest = read_latest(ckpt_dir)
+    assert latest is not None, 'checkpoint: no %s in %s' % (LATEST_FILE, ckpt_dir)
+    return latest['epoch'], latest['path']
+
+
+def read_state(ckpt_dir, epoch, prefix='gan'):
+    # trainer state saved with a checkpoint (input seed, consumed batches, step), None for older checkpoints
+    if (epoch < 0) and (read_latest(ckpt_dir) is None):
+        return None
+    _, path = resolve(ckpt_dir, epoch, prefix)
+    if not os.path.exists(path + '.state.json'):
+        return None
+    with open(path + '.state.json', 'r') as f:
+        return json.load(f)
+
+
+def write_json(filename, value):
+    # write then rename, readers never see a partial file
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def remove_checkpoint(path):
+    for filename in tf.gfile.Glob(path + '.*'):
+        tf.gfile.Remove(filename)
+
+
+class CheckpointManager(object):
+    # save() copies the variables to host memory in one sess.run and returns; a background thread writes them
+    # through a shadow graph (same variable names) and applies the retention policy:
+    #   keep_last: the last N checkpoints (0: keep all), keep_best: the N best by metric (higher is better)
+    # latest.json is replaced atomically after each finished write, so it never points at a partial checkpoint
+    def __init__(self, ckpt_dir, var_list=None, prefix='gan', keep_last=0, keep_best=0, async_save=True,
+                 max_pending=2):
+        if not os.path.exists(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        self.ckpt_dir = ckpt_dir
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.async_save = async_save
+        self.variables = var_list if var_list is not None else tf.global_variables()
+
+        # shadow graph on the host: one variable per training variable, initialized from the snapshot
+        self.shadow_graph = tf.Graph()
+        with self.shadow_graph.as_default(), tf.device('/cpu:0'):
+            self.placeholders = []
+            shadow_vars = {}
+            for var in self.variables:
+                placeholder = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+                self.placeholders.append(placeholder)
+                shadow_vars[var.op.name] = tf.Variable(placeholder, trainable=False)
+            self.shadow_init = tf.variables_initializer(list(shadow_vars.values()))
+            self.shadow_saver = tf.train.Saver(shadow_vars, max_to_keep=None)
+        self.shadow_sess = tf.Session(graph=self.shadow_graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        # saved checkpoints [(epoch, metric)], continued from latest.json
+        latest = read_latest(ckpt_dir)
+        self.saved = [] if latest is None else [(e, latest['metrics'].get(str(e))) for e in latest['kept']]
+
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.closed = False
+        if self.async_save:
+            self.worker = threading.Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+        atexit.register(self.close)
+
+    def save(self, sess, epoch, metric=None, state=None):
+        # metric: e.g. test SSIM of this epoch, used by keep_best
+        # state: json dict stored next to the checkpoint (<path>.state.json), see read_state
+        assert not self.closed, 'CheckpointManager: save after close'
+        self._check()
+        values = sess.run(self.variables)
+        if self.async_save:
+            self.jobs.put((epoch, values, metric, state))
+        else:
+            self._write(epoch, values, metric, state)
+        return checkpoint_path(self.ckpt_dir, self.prefix, epoch)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.jobs.task_done()
+
+    def _write(self, epoch, values, metric, state=None):
+        path = checkpoint_path(self.ckpt_dir, self.prefix, epoch)
+        self.shadow_sess.run(self.shadow_init, feed_dict=dict(zip(self.placeholders, values)))
+        self.shadow_saver.save(self.shadow_sess, path, write_meta_graph=False, write_state=False)
+        if state is not None:
+            write_json(path + '.state.json', state)
+        self.saved = [(e, m) for e, m in self.saved if e != epoch] + [(epoch, metric)]
+        self._retain()
+        self._write_latest(epoch, path)
+
+    def _retain(self):
+        epochs = [e for e, _ in self.saved]
+        if self.keep_last <= 0:
+            return
+        keep = set(epochs[-self.keep_last:])
+        if self.keep_best > 0:
+            scored = [(m, e) for e, m in self.saved if m is not None]
+            keep.update(e for _, e in sorted(scored, reverse=True)[0:self.keep_best])
+        for epoch in epochs:
+            if epoch not in keep:
+                remove_checkpoint(checkpoint_path(self.ckpt_dir, self.prefix, epoch))
+        self.saved = [(e, m) for e, m in self.saved if e in keep]
+
+    def _write_latest(self, epoch, path):
+        latest = {'epoch': epoch, 'path': path, 'kept': [e for e, _ in self.saved],
+                  'metrics': {str(e): m for e, m in self.saved}}
+        scored = [(m, e) for e, m in self.saved if m is not None]
+        if scored:
+            latest['best'] = max(scored)[1]
+        write_json(self.ckpt_dir + '/' + LATEST_FILE, latest)
+
+    def flush(self):
+        if self.async_save:
+            self.jobs.join()
+        self._check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.async_save:
+            self.jobs.put(None)
+            self.worker.join()
+        self.shadow_sess.close()
+        self._check()
+
+    def _check(self):
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
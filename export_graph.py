@@ -0,0 +1,132 @@
+# Freeze one translation direction of a gan_ckpt checkpoint into a single optimized GraphDef
+#   python export_graph.py --ckpt record/step0/gan_ckpt/gan-5000 --direction p2s --out p2s_frozen.pb [--benchmark True]
+#   (--benchmark also checks that the frozen graph gives the output of build_network)
+# The exported graph is built by inference.Translator, so it never contains the tf.cond input switch,
+# the discriminators or the losses. train_mode is a constant, variables become constants, and the
+# graph transforms fold the constant switches and the batch-norm statistics into the conv weights.
+# Instance statistics (the instance half of batch_instance_norm_mine) depend on each input and stay in the graph.
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+import options
+import gan_share
+import inference
+
+INPUT_NAMES = ['content_inp', 'style_inp']
+# style_mean/style_sigma are kept as outputs so fixed-style translation (feeding them) works on the frozen graph
+OUTPUT_NAMES = ['output', 'style_mean', 'style_sigma']
+
+
+def export_graph(ckpt_path, out_path, direction='p2s', enc_model='col_gen_enc', dec_model='col_gen_dec',
+                 med_channels=256, batch_size=8, crop_size=256, img_channels=3):
+    translator = inference.Translator(ckpt_path, direction, enc_model, dec_model, med_channels,
+                                      img_channels=img_channels, batch_size=batch_size, crop_size=crop_size,
+                                      fixed_mode=True)
+    with translator.graph.as_default():
+        frozen = tf.graph_util.convert_variables_to_constants(translator.sess, translator.graph.as_graph_def(),
+                                                              OUTPUT_NAMES)
+    translator.close()
+
+    transforms = ['strip_unused_nodes(type=float, shape="%d,%d,%d,%d")' % (batch_size, crop_size, crop_size, img_channels),
+                  'remove_nodes(op=Identity, op=CheckNumerics)',
+                  'fold_constants(ignore_errors=true)',
+                  'fold_batch_norms',
+                  'fold_old_batch_norms',
+                  'fold_constants(ignore_errors=true)',
+                  'strip_unused_nodes',
+                  'sort_by_execution_order']
+    optimized = TransformGraph(frozen, INPUT_NAMES, OUTPUT_NAMES, transforms)
+    with tf.gfile.GFile(out_path, 'wb') as f:
+        f.write(optimized.SerializeToString())
+    print("frozen: %d nodes, optimized: %d nodes -> %s" % (len(frozen.node), len(optimized.node), out_path))
+    return out_path
+
+
+def time_runs(sess, output, feed_dict, iterations):
+    latencies = []
+    for _ in range(iterations):
+        start_time = time.time()
+        sess.run(output, feed_dict=feed_dict)
+        latencies.append(time.time() - start_time)
+    return 1000 * np.mean(latencies)
+
+
+def bench_rebuild(config, iterations, content, style):
+    # baseline: GAN.build_network (both directions, train_mode switch) + Saver.restore
+    start_time = time.time()
+    graph = tf.Graph()
+    with graph.as_default():
+        net = gan_share.GAN(config)
+        net.train_mode = tf.placeholder(tf.bool, name='train_mode')
+        net.photo_inp = tf.placeholder(tf.float32, content.shape, name='photo_inp')
+        net.sketch_inp = tf.placeholder(tf.float32, style.shape, name='sketch_inp')
+        net.build_network(mode='test_gan')
+        sess = tf.Session(graph=graph)
+        tf.train.Saver().restore(sess, config.ckpt)
+        if config.direction == 'p2s':
+            output = net.gen_sketch
+            feed_dict = {net.photo_inp: content, net.sketch_inp: style, net.train_mode: False}
+        else:
+            output = net.gen_photo
+            feed_dict = {net.sketch_inp: content, net.photo_inp: style, net.train_mode: False}
+        result = sess.run(output, feed_dict=feed_dict)
+        startup = time.time() - start_time
+        latency = time_runs(sess, output, feed_dict, iterations)
+        sess.close()
+    return startup, latency, result
+
+
+def bench_frozen(config, iterations, content, style):
+    start_time = time.time()
+    translator = inference.FrozenTranslator(config.out, config.direction, config.batch_size)
+    feed_dict = {translator.content_inp: content, translator.style_inp: style}
+    result = translator.sess.run(translator.output, feed_dict=feed_dict)
+    startup = time.time() - start_time
+    latency = time_runs(translator.sess, translator.output, feed_dict, iterations)
+    translator.close()
+    return startup, latency, result
+
+
+def benchmark(config, iterations=20, tolerance=1e-3):
+    # startup and latency of the frozen graph against build_network + restore, on the same content/style batch;
+    # the outputs must agree within tolerance (max abs diff), so a wrong fold (e.g. the batch_instance switch) fails
+    shape = [config.batch_size, 256, 256, 3]
+    content = np.random.uniform(-1, 1, shape).astype(np.float32)
+    style = np.random.uniform(-1, 1, shape).astype(np.float32)
+    gan_config = options.default_config(g_enc_model=config.g_enc_model, g_dec_model=config.g_dec_model,
+                                        med_channels=config.med_channels, batch_size=config.batch_size,
+                                        ts_batch_size=config.batch_size)
+    gan_config.ckpt = config.ckpt
+    gan_config.direction = config.direction
+    rebuild = bench_rebuild(gan_config, iterations, content, style)
+    frozen = bench_frozen(config, iterations, content, style)
+    print("%-20s startup %8.1f ms  latency %8.2f ms/batch" % ('build_network', 1000 * rebuild[0], rebuild[1]))
+    print("%-20s startup %8.1f ms  latency %8.2f ms/batch" % ('frozen', 1000 * frozen[0], frozen[1]))
+    print("gain: startup %.2fx, latency %.2fx" % (rebuild[0] / frozen[0], rebuild[1] / frozen[1]))
+    max_diff = float(np.max(np.abs(rebuild[2] - frozen[2])))
+    print("output max abs diff: %.2e (tolerance %.0e)" % (max_diff, tolerance))
+    assert max_diff <= tolerance, 'export_graph: frozen output differs from build_network by %.2e' % max_diff
+    return rebuild, frozen, max_diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', type=str, default='record/step0/gan_ckpt/gan-5000')
+    parser.add_argument('--direction', type=str, default='p2s')  # p2s, s2p
+    parser.add_argument('--out', type=str, default='record/step0/gan_p2s_frozen.pb')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--g_enc_model', type=str, default='col_gen_enc')
+    parser.add_argument('--g_dec_model', type=str, default='col_gen_dec')
+    parser.add_argument('--med_channels', type=int, default=256)
+    parser.add_argument('--benchmark', type=options.str2bool, default=False)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--tolerance', type=float, default=1e-3)  # max abs output diff frozen vs. build_network
+    config = parser.parse_args()
+
+    export_graph(config.ckpt, config.out, config.direction, config.g_enc_model, config.g_dec_model,
+                 config.med_channels, config.batch_size)
+    if config.benchmark:
+        benchmark(config, config.iterations, config.tolerance)
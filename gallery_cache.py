@@ -0,0 +1,101 @@
+# On-disk cache of encoded gallery features (pooled gallery_med of GAN.build_network), one directory per checkpoint
+# and encoding parameters (gallery grid, image preprocessing): <cache_dir>/<checkpoint hash>_<params hash>
+# <cache_dir>/<key>/features.npy: float32 [N, D] (read with mmap_mode='r')
+# <cache_dir>/<key>/index.json: {'paths': [...], 'mtimes': [...], 'sizes': [...], 'params': {...}}, row i of features
+# an entry is valid while its image file keeps the same mtime and size; new or changed images are re-encoded
+import os
+import json
+import hashlib
+import numpy as np
+
+import checkpoint
+
+INDEX_FILE = 'index.json'
+FEATURES_FILE = 'features.npy'
+
+
+def checkpoint_hash(ckpt_path, block_size=2**20):
+    # sha1 of the checkpoint files (<ckpt_path>.index, .data-*), the same weights give the same key
+    sha = hashlib.sha1()
+    filenames = sorted(f for f in os.listdir(os.path.dirname(ckpt_path) or '.')
+                       if f.startswith(os.path.basename(ckpt_path) + '.') and not f.endswith('.json'))
+    assert filenames, 'gallery_cache: no checkpoint files for %s' % ckpt_path
+    for filename in filenames:
+        sha.update(filename[len(os.path.basename(ckpt_path)):].encode('utf-8'))
+        with open(os.path.join(os.path.dirname(ckpt_path), filename), 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def params_hash(params):
+    # sha1 of the encoding parameters, features encoded with other parameters get another key
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[0:12]
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+class GalleryFeatureCache(object):
+    def __init__(self, cache_dir, ckpt_hash, params=None):
+        # params: json-serializable encoding parameters the features depend on (part of the key, kept in the index)
+        self.params = params if params is not None else {}
+        self.cache_dir = cache_dir + '/' + ckpt_hash + '_' + params_hash(self.params)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.rows = {}  # path -> (row, mtime, size)
+        self.features = None
+        index_path = self.cache_dir + '/' + INDEX_FILE
+        if os.path.exists(index_path) and os.path.exists(self.cache_dir + '/' + FEATURES_FILE):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            assert index.get('params', {}) == self.params, 'gallery_cache: encoding parameters differ in %s' % index_path
+            self.rows = {p: (k, m, s) for k, (p, m, s) in enumerate(zip(index['paths'], index['mtimes'],
+                                                                          index['sizes']))}
+            self.features = np.load(self.cache_dir + '/' + FEATURES_FILE, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def missing(self, paths):
+        # paths without a valid entry (not cached, or the file changed since)
+        missing = []
+        for path in paths:
+            entry = self.rows.get(path)
+            if (entry is None) or (entry[1:] != file_signature(path)):
+                missing.append(path)
+        return missing
+
+    def update(self, paths, features):
+        # add / replace the entries of paths, then rewrite the cache files (write and rename)
+        # the whole feature file is copied, so call it once with all new features, not per batch
+        features = np.asarray(features, dtype=np.float32)
+        new_paths = [p for p in paths if p not in self.rows]
+        num = len(self.rows) + len(new_paths)
+        merged = np.empty([num, features.shape[1]], dtype=np.float32)
+        if self.features is not None:
+            merged[0:len(self.features)] = self.features
+        for path in new_paths:
+            self.rows[path] = (len(self.rows), None, None)
+        for path, feature in zip(paths, features):
+            row = self.rows[path][0]
+            merged[row] = feature
+            self.rows[path] = (row,) + file_signature(path)
+        with open(self.cache_dir + '/' + FEATURES_FILE + '.tmp', 'wb') as f:
+            np.save(f, merged)
+        os.replace(self.cache_dir + '/' + FEATURES_FILE + '.tmp', self.cache_dir + '/' + FEATURES_FILE)
+        ordered = sorted(self.rows.items(), key=lambda item: item[1][0])
+        checkpoint.write_json(self.cache_dir + '/' + INDEX_FILE,
+                              {'paths': [p for p, _ in ordered], 'mtimes': [e[1] for _, e in ordered],
+                               'sizes': [e[2] for _, e in ordered], 'params': self.params})
+        self.features = np.load(self.cache_dir + '/' + FEATURES_FILE, mmap_mode='r')
+
+    def lookup(self, paths):
+        # float32 [len(paths), D] of cached paths, in the order of paths
+        rows = np.array([self.rows[p][0] for p in paths], dtype=np.int64)
+        order = np.argsort(rows)
+        features = np.empty([len(paths), self.features.shape[1]], dtype=np.float32)
+        features[order] = self.features[rows[order]]
+        return features
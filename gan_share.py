@@ -1,13 +1,139 @@
 import numpy as np
+import numbers
 import time
 import os
 import tensorflow as tf
 import model
 import input_data
+import precision
+import checkpoint
+import profiler
+import gallery_cache
 import ADAIN
 from utils import *
 
 
+# data parallel: per-tower outputs gathered after build_replicas, images concatenated and scalars averaged
+TOWER_CONCAT = ['gen_sketch', 'gen_photo', 'gen_med_p2s', 'gen_med_s2p']
+TOWER_MEAN = ['g_loss', 'd_loss', 'adv_loss', 's_loss', 'average_ssim', 'ssim_score_photo', 'ssim_score_sketch']
+
+
+def split_batch(tensor, num):
+    # split along the batch axis into num parts, sizes differ by at most one (e.g. test batch 5 on 2 towers)
+    # training batches are always split evenly (asserted in GAN.__init__)
+    batch = tf.shape(tensor)[0]
+    sizes = [(batch + num - 1 - i) // num for i in range(num)]
+    return tf.split(tensor, tf.stack(sizes), axis=0, num=num)
+
+
+def average_gradients(tower_grads):
+    # [[(grad, var), ...] per tower] -> [(mean grad, var), ...], towers share variables so the lists are aligned
+    average_grads = []
+    for grads_and_vars in zip(*tower_grads):
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        var = grads_and_vars[0][1]
+        if len(grads) == 0:
+            average_grads.append((None, var))
+        else:
+            average_grads.append((tf.add_n(grads) / float(len(grads)), var))
+    return average_grads
+
+
+def zero_variables(variables, name=None):
+    return tf.group(*[var.assign(tf.zeros(var.get_shape(), var.dtype.base_dtype)) for var in variables], name=name)
+
+
+def update_plan(schedule='fused', n_critic=1):
+    # sess.run groups of one training step, n_critic discriminator updates per generator update
+    #   'fused': the last discriminator update and the generator update share one run (one forward pass)
+    #   'alternate': separate discriminator and generator runs, each on its own batch
+    plan = [('d',)] * (n_critic - 1)
+    if schedule == 'fused':
+        plan.append(('d', 'g'))
+    elif schedule == 'alternate':
+        plan += [('d',), ('g',)]
+    else:
+        assert False, 'Wrong update schedule'
+    return plan
+
+
+def config_network(model_key, norm='instance', output_channels=1, output_activation='lrelu', se_block=False,
+                   recompute=False):
+    # select network model
+    # layer specs = (type, out_channels, stride, ksize)
+    print(model_key)
+    if (model_key == 'pix2pix') or (model_key == 'p2p'):
+        build_func = model.Unet
+        config = {'layer_specs': [('conv', 64, 1, 4), ('conv', 128, 2, 4), ('conv', 256, 2, 4),
+                                  ('conv', 512, 2, 4), ('conv', 512, 2, 4), ('conv', 512, 2, 4),
+                                  ('conv', 512, 2, 4), ('conv', 512, 1, 4)],
+                  'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': se_block, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    elif (model_key == 'col_gen') or (model_key == 'Col_Gen') or (model_key == 'res9'):
+        build_func = model.CNN_Encoder
+        config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
+                                  ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
+                                  ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
+                                  ('res', 256, 1, 3), ('dconv', 128, 2, 3), ('dconv', 64, 2, 3), ('conv', output_channels, 1, 7)],
+                  'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': se_block, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    elif (model_key == 'res4'):
+        build_func = model.CNN_Encoder
+        config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
+                                  ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), 
+                                  ('dconv', 128, 2, 3), ('dconv', 64, 2, 3), ('conv', output_channels, 1, 7)],
+                  'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': se_block, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    elif (model_key == 'col_gen_enc') or (model_key == 'Col_Gen_enc'):
+        build_func = model.CNN_Encoder
+        config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
+                                  ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3)],
+                  'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': True, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    elif (model_key == 'col_gen_dec') or (model_key == 'Col_Gen_dec'):
+        build_func = model.CNN_Encoder
+        config = {'layer_specs': [('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
+                                  ('dconv', 128, 2, 3), ('dconv', 64, 2, 3), ('conv', output_channels, 1, 7)],
+                  'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': se_block, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    elif (model_key == 'col_gen_old'):
+        build_func = model.CNN_Encoder
+        config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
+                                  ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
+                                  ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
+                                  ('res', 256, 1, 3), ('dconv_o', 128, 2, 3), ('dconv_o', 64, 2, 3), ('conv', output_channels, 1, 7)],
+                  'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': se_block, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    elif (model_key == 'res4_old'):
+        build_func = model.CNN_Encoder
+        config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
+                                  ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), 
+                                  ('dconv_o', 128, 2, 3), ('dconv_o', 64, 2, 3), ('conv', output_channels, 1, 7)],
+                  'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': se_block, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    elif (model_key == 'patchgan') or (model_key == 'PatchGAN'):
+        build_func = model.CNN_Encoder
+        #  sigmoid at last layer
+        config = {'layer_specs': [('conv', 64, 2, 4), ('conv', 128, 2, 4), ('conv', 256, 2, 4),
+                                  ('conv', 512, 2, 4), ('conv', output_channels, 1, 4)],
+                  'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
+                  'se-block': se_block, 'output_channels': output_channels,
+                  'output_activation': output_activation}
+    else:
+        assert False, 'Config_network: Wrong model'
+    # recompute residual block activations in the backward pass (CNN_Encoder)
+    config['recompute'] = recompute
+
+    return build_func, config
+
+
 # GAN
 class GAN(object):
     def __init__(self, config):
@@ -26,6 +152,15 @@ class GAN(object):
         self.ts_batch_size = config.ts_batch_size  #1
         self.flip = True
         self.num_identity = None #config.num_identity  # num of training data
+        self.input_engine = config.input_engine  # 'queue', 'dataset' or 'shard'
+        self.input_threads = config.input_threads  # parallel decode/preprocess calls (dataset engine)
+        self.prefetch_size = config.prefetch_size  # batches prefetched (dataset engine)
+        self.input_seed = config.input_seed if config.input_seed >= 0 else None
+        if (self.input_seed is None) and (self.input_engine != 'queue'):
+            # drawn here so checkpoints can record it (resume)
+            self.input_seed = int(np.random.randint(0, 2**31 - 1))
+        self.input_bench_steps = config.input_bench_steps  # measure input photo/sketch pairs/sec before training (0: off)
+        self.batch_augment = config.batch_augment  # crop/flip after batching (dataset engine)
         # network architecture
         self.generator_model = config.g_model  # 'alex'  # Select model
         self.use_enc_dec = config.use_enc_dec
@@ -34,8 +169,8 @@ class GAN(object):
         self.med_channels = config.med_channels
         self.discriminator_model = config.d_model  # 'alex'  # Select model
         self.share = 9999  # weight sharing is started at
-        self.normG = 'batch_instance' #'instance'
-        self.normD = 'batch_instance' #'batch'
+        self.normG = config.norm_g  # 'batch_instance', 'instance'
+        self.normD = config.norm_d  # 'batch_instance', 'batch'
         self.gan_loss = 'log'
         self.med_domain = True
         self.discriminator_method = 'col-cgan'
@@ -48,6 +183,15 @@ class GAN(object):
         self.cycle = False
         self.weight_decay = None  # 0.0005
         self.se_block = False
+        self.recompute = config.recompute  # gradient checkpointing at residual block boundaries
+        # a recomputed block runs again in the backward pass, so its moving-statistics updates would be applied twice
+        assert not (self.recompute and ('batch' in self.normG or 'batch' in self.normD)), \
+            'GAN: recompute needs per-sample norms (instance or none), got %s/%s' % (self.normG, self.normD)
+        self.fused_adain = config.fused_adain  # model.AdaIN_fused instead of model.AdaIN_p2s_s2p_new
+        # gallery: content of gallery_med pooled on a grid x grid grid (gallery_feature, comparable with content_s2p),
+        # cached per checkpoint in gallery_cache_dir
+        self.gallery_grid = config.gallery_grid
+        self.gallery_cache_dir = config.gallery_cache_dir
         self.share_g1 = False
         self.share_g2 = False
         if config.d_p2s == 'True':
@@ -59,6 +203,34 @@ class GAN(object):
         else:
             self.add_discriminators_s2p = False
         self.med_d_lambda = config.med_d_lambda
+        self.fuse_passes = config.fuse_passes  # stack inputs that share weights into one generator/discriminator pass
+        # stacked real/fake (stylized/content) samples would share batch statistics in train mode and change the losses
+        assert not (self.fuse_passes and ('batch' in self.normG or 'batch' in self.normD)), \
+            'GAN: fuse_passes needs per-sample norms (instance or none), got %s/%s' % (self.normG, self.normD)
+        # mixed precision: None or 'fp16' compute with fp32 master weights
+        self.mixed_precision = config.mixed_precision if config.mixed_precision != 'none' else None
+        if self.mixed_precision is not None:
+            self.compute_dtype = precision.compute_dtype(self.mixed_precision)
+        # data parallel: towers on num_replicas devices ('gpu' or virtual 'cpu'), batch_size is split between them
+        self.num_replicas = config.num_replicas
+        self.replica_device = config.replica_device
+        if self.num_replicas > 1:
+            assert self.ts_batch_size >= self.num_replicas, 'GAN: ts_batch_size smaller than num_replicas'
+        # gradient accumulation: batch_size is one update, read as accum_steps micro-batches
+        self.accum_steps = config.accum_steps
+        # update scheduler: n_critic discriminator updates per generator update, fused or alternate runs
+        self.update_schedule = config.update_schedule
+        self.n_critic = config.n_critic
+        self.update_plan = update_plan(self.update_schedule, self.n_critic)
+        self.runs_per_step = len(self.update_plan) * self.accum_steps  # batches pulled per training step
+        assert self.batch_size % self.accum_steps == 0, 'GAN: batch_size is not divisible by accum_steps'
+        self.micro_batch_size = self.batch_size // self.accum_steps
+        if self.num_replicas > 1:
+            # towers must be the same size: the tower gradients and the scaled similarity losses are plain means
+            assert self.micro_batch_size % self.num_replicas == 0, 'GAN: micro batch is not divisible by num_replicas'
+        # scale of the batch-summed similarity losses, so the average over towers/micro-batches equals the full batch loss
+        # (num_replicas, set by build_replicas; x accum_steps in train mode only, the test batch is not split by it)
+        self.loss_batch_scale = 1
         # trainer
         self.max_epoch = config.max_epoch  # 2000
         self.g_learning_rate = config.g_lr
@@ -72,9 +244,15 @@ class GAN(object):
         # records
         self.log_dir = config.log_dir  # "record"
         self.summary_step = 50  # write tensorboard summary
+        self.summary_mode = config.summary_mode  # 'fused', 'scalar' (fused, scalars only), 'separate', 'none'
         self.print_epoch = config.print_epoch  # print losses
         self.save_epoch = config.save_epoch  # save model
         self.display_epoch = 1  #250
+        self.ts_display_batches = config.ts_display_batches  # test batches whose images are saved (-1: all)
+        self.writer_threads = config.writer_threads  # background image writers (0: write in the training loop)
+        self.writer_queue = config.writer_queue  # pending test batches before the training loop blocks
+        self.html_rows_per_page = 500  # rows per page of the incremental results report
+        self.profile_trace_every = config.profile_trace_every  # step trace (timeline) every N steps, 0: off
         if config.use_enc_dec:
             self.display_list = ['inp_photo', 'gen_photo', 'gen_sketch', 'inp_sketch']
         else:
@@ -82,84 +260,93 @@ class GAN(object):
         # to continue training, you must use same network architecture
         self.continue_training = config.continue_tr  # False
         self.load_dir = self.log_dir + "/gan_ckpt"
-        self.load_epoch = config.load_epoch  # 500
+        self.load_epoch = config.load_epoch  # 500, -1: latest
+        # checkpoints: written in the background with --ckpt_async, keep the last N (0: all) and the N best by test SSIM
+        self.ckpt_async = config.ckpt_async
+        self.ckpt_keep_last = config.ckpt_keep_last
+        self.ckpt_keep_best = config.ckpt_keep_best
         # Select GPU
         self.gpu_num = config.gpu_num
+        self.start_time = time.time()  # for the time to first step
 
     def config_network(self, model_key, norm='instance', output_channels=1, output_activation='lrelu'):
-        # select network model
-        # layer specs = (type, out_channels, stride, ksize)
-        print(model_key)
-        if (model_key == 'pix2pix') or (model_key == 'p2p'):
-            build_func = model.Unet
-            config = {'layer_specs': [('conv', 64, 1, 4), ('conv', 128, 2, 4), ('conv', 256, 2, 4),
-                                      ('conv', 512, 2, 4), ('conv', 512, 2, 4), ('conv', 512, 2, 4),
-                                      ('conv', 512, 2, 4), ('conv', 512, 1, 4)],
-                      'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': self.se_block, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        elif (model_key == 'col_gen') or (model_key == 'Col_Gen') or (model_key == 'res9'):
-            build_func = model.CNN_Encoder
-            config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
-                                      ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
-                                      ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
-                                      ('res', 256, 1, 3), ('dconv', 128, 2, 3), ('dconv', 64, 2, 3), ('conv', output_channels, 1, 7)],
-                      'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': self.se_block, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        elif (model_key == 'res4'):
-            build_func = model.CNN_Encoder
-            config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
-                                      ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), 
-                                      ('dconv', 128, 2, 3), ('dconv', 64, 2, 3), ('conv', output_channels, 1, 7)],
-                      'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': self.se_block, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        elif (model_key == 'col_gen_enc') or (model_key == 'Col_Gen_enc'):
-            build_func = model.CNN_Encoder
-            config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
-                                      ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3)],
-                      'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': True, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        elif (model_key == 'col_gen_dec') or (model_key == 'Col_Gen_dec'):
-            build_func = model.CNN_Encoder
-            config = {'layer_specs': [('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
-                                      ('dconv', 128, 2, 3), ('dconv', 64, 2, 3), ('conv', output_channels, 1, 7)],
-                      'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': self.se_block, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        elif (model_key == 'col_gen_old'):
-            build_func = model.CNN_Encoder
-            config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
-                                      ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
-                                      ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3),
-                                      ('res', 256, 1, 3), ('dconv_o', 128, 2, 3), ('dconv_o', 64, 2, 3), ('conv', output_channels, 1, 7)],
-                      'rectifier': 'relu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': self.se_block, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        elif (model_key == 'res4_old'):
-            build_func = model.CNN_Encoder
-            config = {'layer_specs': [('conv', 64, 1, 7), ('conv', 128, 2, 3), ('conv', 256, 2, 3),
-                                      ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), ('res', 256, 1, 3), 
-                                      ('dconv_o', 128, 2, 3), ('dconv_o', 64, 2, 3), ('conv', output_channels, 1, 7)],
-                      'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': self.se_block, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        elif (model_key == 'patchgan') or (model_key == 'PatchGAN'):
-            build_func = model.CNN_Encoder
-            #  sigmoid at last layer
-            config = {'layer_specs': [('conv', 64, 2, 4), ('conv', 128, 2, 4), ('conv', 256, 2, 4),
-                                      ('conv', 512, 2, 4), ('conv', output_channels, 1, 4)],
-                      'rectifier': 'lrelu', 'norm': norm, 'padding': 'SAME', 'use_bias': True,
-                      'se-block': self.se_block, 'output_channels': output_channels,
-                      'output_activation': output_activation}
-        else:
-            assert False, 'Config_network: Wrong model'
-
-        return build_func, config
+        return config_network(model_key, norm, output_channels, output_activation, self.se_block, self.recompute)
+
+    def fused_pass(self, build_func, inputs, config, name, **kwargs):
+        # one build_func call on inputs stacked along the batch axis instead of one call (reuse=True) per input
+        # outputs match the separate calls only for per-sample norms ('instance', none), see the check in __init__
+        outputs = build_func(tf.concat(inputs, axis=0), config, self.train_mode, name=name, reuse=False, **kwargs)
+        return tf.split(outputs, len(inputs), axis=0)
+
+    def precision_wrap(self, build_func, sigmoid=False):
+        # mixed precision: network runs in the compute dtype, its output (AdaIN moments, losses) in fp32
+        # sigmoid=True applies the discriminator output activation after the cast to fp32
+        if self.mixed_precision is None:
+            return build_func
+
+        def build(inputs, *args, **kwargs):
+            outputs = build_func(tf.cast(inputs, self.compute_dtype), *args, **kwargs)
+            outputs = tf.cast(outputs, tf.float32)
+            if sigmoid:
+                outputs = tf.sigmoid(outputs)
+            return outputs
+        return build
+
+    def replica_devices(self):
+        return ['/%s:%d' % (self.replica_device, i) for i in range(self.num_replicas)]
+
+    def session_config(self):
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        config.allow_soft_placement = True
+        config.log_device_placement = False
+        if (self.num_replicas > 1) and (self.replica_device == 'cpu'):
+            # virtual cpu devices, one per tower (they share the host thread pools)
+            config.device_count['CPU'] = self.num_replicas
+        return config
 
     def build_network(self, mode='train', test_gallery=False):
+        # created once, shared by the towers
+        self.med_lambda_p = tf.placeholder(tf.float32, name='med_lambda')
+        if (self.num_replicas > 1) and (mode == 'train_gan'):
+            build_func = self.build_replicas
+        else:
+            build_func = self.build_network_graph
+        if self.mixed_precision is not None:
+            getter = precision.float32_variable_getter(self.compute_dtype)
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=getter):
+                return build_func(mode, test_gallery)
+        return build_func(mode, test_gallery)
+
+    def build_replicas(self, mode='train_gan', test_gallery=False):
+        # one build_network_graph per device on a slice of the batch, tower 0 creates the variables
+        # batch norm statistics are per tower
+        photo_inp, sketch_inp = self.photo_inp, self.sketch_inp
+        photo_splits = split_batch(photo_inp, self.num_replicas)
+        sketch_splits = split_batch(sketch_inp, self.num_replicas)
+        self.loss_batch_scale = self.num_replicas
+        self.towers = []
+        with tf.variable_scope(tf.get_variable_scope()):
+            for i, device in enumerate(self.replica_devices()):
+                with tf.device(device), tf.name_scope('tower_%d' % i):
+                    self.photo_inp, self.sketch_inp = photo_splits[i], sketch_splits[i]
+                    self.build_network_graph(mode, test_gallery)
+                    self.towers.append({key: getattr(self, key) for key in TOWER_CONCAT + TOWER_MEAN
+                                        if hasattr(self, key)})
+                    tf.get_variable_scope().reuse_variables()
+        print('build_replicas: %d towers on %s' % (self.num_replicas, ', '.join(self.replica_devices())))
+
+        # full batch views for the training loop
+        self.photo_inp, self.sketch_inp = photo_inp, sketch_inp
+        for key in self.towers[0]:
+            values = [tower[key] for tower in self.towers]
+            if key in TOWER_CONCAT:
+                setattr(self, key, tf.concat(values, axis=0))
+            else:
+                setattr(self, key, tf.add_n(values) / float(self.num_replicas))
+        return
+
+    def build_network_graph(self, mode='train', test_gallery=False):
         # config generator
         if self.use_enc_dec:
             print('Use enc dec')
@@ -167,9 +354,12 @@ class GAN(object):
                                                              output_channels=self.med_channels, output_activation=None)
             decoder, self.g_dec_config = self.config_network(self.g_decoder_model, self.normG,
                                                              output_channels=self.img_channels, output_activation='tanh')
+            encoder = self.precision_wrap(encoder)
+            decoder = self.precision_wrap(decoder)
         else:
             generator, self.g_config = self.config_network(self.generator_model, self.normG, output_channels=self.img_channels,
                                                        output_activation='tanh')
+            generator = self.precision_wrap(generator)
 
         # photo to sketch
         if self.med_domain:
@@ -195,32 +385,44 @@ class GAN(object):
 
                 #self.gen_med_p2s, self.content_p2s, self.style_p2s, self.gen_med_s2p, self.content_s2p, self.style_s2p = model.AdaIN_p2s_s2p_new(self.gen_med_p2s, self.gen_med_s2p) #
                 #self.gen_med_p2s, self.content_p2s, self.gen_med_s2p, self.content_s2p = model.AdaIN_p2s_s2p(self.gen_med_p2s, self.gen_med_s2p) #
-                self.gen_med_p2s, self.gen_med_p2s1, self.content_p2s, self.gen_med_s2p, self.gen_med_s2p1, self.content_s2p = model.AdaIN_p2s_s2p_new(self.gen_med_p2s, self.gen_med_s2p) #
+                adain = model.AdaIN_fused if self.fused_adain else model.AdaIN_p2s_s2p_new
+                self.gen_med_p2s, self.gen_med_p2s1, self.content_p2s, self.gen_med_s2p, self.gen_med_s2p1, self.content_s2p = adain(self.gen_med_p2s, self.gen_med_s2p) #
 
 #-------------------------
                 if test_gallery:
                     self.gallery_med = encoder(self.gallery_inp, self.g_enc_config, self.train_mode, name="Gen_p2s_A_",
                                            reuse=True, share_name='Gen_A_', share_reuse=True, share=self.share)
-                self.gen_sketch = decoder(self.gen_med_p2s, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
-                                          reuse=False, share_name='Gen_B_', share_reuse=False, share=-self.share)
-                self.gen_sketch1 = decoder(self.gen_med_p2s1, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
-                                          reuse=True, share_name='Gen_B_', share_reuse=True, share=-self.share)
-                if self.share_g2:
-                    self.gen_photo = decoder(self.gen_med_s2p, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
-                                          reuse=True, share_name='Gen_B_', share_reuse=True, share=-self.share)
-                    self.gen_photo = decoder(self.gen_med_s2p1, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
-                                          reuse=True, share_name='Gen_B_', share_reuse=True, share=-self.share)
+                    self.gallery_feature = model.grid_pool(model.instance_content(self.gallery_med), self.gallery_grid)
+                if self.fuse_passes and not self.share_g2:
+                    # one decoder pass per direction on [stylized; content] stacked along the batch axis
+                    self.gen_sketch, self.gen_sketch1 = self.fused_pass(decoder, [self.gen_med_p2s, self.gen_med_p2s1],
+                                                                        self.g_dec_config, "Gen_p2s_B_", share_name='Gen_B_',
+                                                                        share_reuse=False, share=-self.share)
+                    self.gen_photo, self.gen_photo1 = self.fused_pass(decoder, [self.gen_med_s2p, self.gen_med_s2p1],
+                                                                      self.g_dec_config, "Gen_s2p_B_", share_name='Gen_B_',
+                                                                      share_reuse=False, share=self.share)
                 else:
-                    self.gen_photo = decoder(self.gen_med_s2p, self.g_dec_config, self.train_mode, name="Gen_s2p_B_",
-                                           reuse=False, share_name='Gen_B_', share_reuse=False, share=self.share)
-                    self.gen_photo1 = decoder(self.gen_med_s2p1, self.g_dec_config, self.train_mode, name="Gen_s2p_B_",
-                                           reuse=True, share_name='Gen_B_', share_reuse=True, share=self.share)
+                    self.gen_sketch = decoder(self.gen_med_p2s, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
+                                              reuse=False, share_name='Gen_B_', share_reuse=False, share=-self.share)
+                    self.gen_sketch1 = decoder(self.gen_med_p2s1, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
+                                              reuse=True, share_name='Gen_B_', share_reuse=True, share=-self.share)
+                    if self.share_g2:
+                        self.gen_photo = decoder(self.gen_med_s2p, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
+                                              reuse=True, share_name='Gen_B_', share_reuse=True, share=-self.share)
+                        self.gen_photo = decoder(self.gen_med_s2p1, self.g_dec_config, self.train_mode, name="Gen_p2s_B_",
+                                              reuse=True, share_name='Gen_B_', share_reuse=True, share=-self.share)
+                    else:
+                        self.gen_photo = decoder(self.gen_med_s2p, self.g_dec_config, self.train_mode, name="Gen_s2p_B_",
+                                               reuse=False, share_name='Gen_B_', share_reuse=False, share=self.share)
+                        self.gen_photo1 = decoder(self.gen_med_s2p1, self.g_dec_config, self.train_mode, name="Gen_s2p_B_",
+                                               reuse=True, share_name='Gen_B_', share_reuse=True, share=self.share)
             else:
                 self.gen_med_p2s = generator(self.photo_inp, self.g_config, self.train_mode, name="Gen_p2s_A_",
                                            reuse=False, share_name='Gen_A_', share_reuse=False, share=self.share)
                 if test_gallery:
                     self.gallery_med = generator(self.gallery_inp, self.g_config, self.train_mode, name="Gen_p2s_A_",
                                            reuse=True, share_name='Gen_A_', share_reuse=True, share=self.share)
+                    self.gallery_feature = model.grid_pool(model.instance_content(self.gallery_med), self.gallery_grid)
                 self.gen_sketch = generator(self.gen_med_p2s, self.g_config, self.train_mode, name="Gen_p2s_B_",
                                            reuse=False, share_name='Gen_B_', share_reuse=False, share=self.share)
                 self.gen_med_s2p = generator(self.sketch_inp, self.g_config, self.train_mode, name="Gen_s2p_A_",
@@ -260,15 +462,28 @@ class GAN(object):
                 assert False, 'discriminator method error'
 
             # config discriminator
-            discriminator, self.d_config = self.config_network(self.discriminator_model, self.normD, output_channels=1,
-                                                               output_activation='sigmoid')
+            if self.mixed_precision is None:
+                discriminator, self.d_config = self.config_network(self.discriminator_model, self.normD, output_channels=1,
+                                                                   output_activation='sigmoid')
+            else:
+                # sigmoid in fp32
+                discriminator, self.d_config = self.config_network(self.discriminator_model, self.normD, output_channels=1,
+                                                                   output_activation=None)
+                discriminator = self.precision_wrap(discriminator, sigmoid=True)
             # build discriminators
-            self.dreal_p2s = discriminator(self.realAB_p2s, self.d_config, self.train_mode, name="Dis_p2s_", reuse=False)
-            self.dfake_p2s = discriminator(self.genAB_sk, self.d_config, self.train_mode, name="Dis_p2s_", reuse=True)
-            self.dfake_p2s1 = discriminator(self.genAB_sk1, self.d_config, self.train_mode, name="Dis_p2s_", reuse=True)
-            self.dreal_s2p = discriminator(self.realAB_s2p, self.d_config, self.train_mode, name="Dis_s2p_", reuse=False)
-            self.dfake_s2p = discriminator(self.genAB_ph, self.d_config, self.train_mode, name="Dis_s2p_", reuse=True)
-            self.dfake_s2p1 = discriminator(self.genAB_ph1, self.d_config, self.train_mode, name="Dis_s2p_", reuse=True)
+            if self.fuse_passes:
+                # each discriminator runs once on [real; fake; fake1]
+                self.dreal_p2s, self.dfake_p2s, self.dfake_p2s1 = \
+                    self.fused_pass(discriminator, [self.realAB_p2s, self.genAB_sk, self.genAB_sk1], self.d_config, "Dis_p2s_")
+                self.dreal_s2p, self.dfake_s2p, self.dfake_s2p1 = \
+                    self.fused_pass(discriminator, [self.realAB_s2p, self.genAB_ph, self.genAB_ph1], self.d_config, "Dis_s2p_")
+            else:
+                self.dreal_p2s = discriminator(self.realAB_p2s, self.d_config, self.train_mode, name="Dis_p2s_", reuse=False)
+                self.dfake_p2s = discriminator(self.genAB_sk, self.d_config, self.train_mode, name="Dis_p2s_", reuse=True)
+                self.dfake_p2s1 = discriminator(self.genAB_sk1, self.d_config, self.train_mode, name="Dis_p2s_", reuse=True)
+                self.dreal_s2p = discriminator(self.realAB_s2p, self.d_config, self.train_mode, name="Dis_s2p_", reuse=False)
+                self.dfake_s2p = discriminator(self.genAB_ph, self.d_config, self.train_mode, name="Dis_s2p_", reuse=True)
+                self.dfake_s2p1 = discriminator(self.genAB_ph1, self.d_config, self.train_mode, name="Dis_s2p_", reuse=True)
 
             # adversarial loss
             self.adv_loss_p2s, self.d_loss_p2s = model.GAN_loss_bin(self.dfake_p2s, self.dreal_p2s, self.gan_loss)
@@ -357,20 +572,25 @@ class GAN(object):
 
             # similarity loss
             if self.similarity_loss is not None:
+                batch_scale = float(self.loss_batch_scale)
+                if self.accum_steps > 1:
+                    batch_scale = tf.cond(self.train_mode, lambda: tf.constant(batch_scale * self.accum_steps),
+                                          lambda: tf.constant(batch_scale))
+
                 def calc_similarity(imgA, imgB, metric, ssim_lambda=1.0):
                     if metric == 'L1':
                         # similarity = tf.reduce_mean(tf.abs(imgA - imgB))
-                        similarity = tf.reduce_mean(tf.reduce_sum(tf.abs(imgA - imgB), axis=0))
+                        similarity = batch_scale * tf.reduce_mean(tf.reduce_sum(tf.abs(imgA - imgB), axis=0))
                     elif metric == 'L2':
                         # similarity = tf.reduce_mean((imgA - imgB) ** 2)
-                        similarity = tf.reduce_mean(tf.reduce_sum((imgA - imgB) ** 2, axis=0))
+                        similarity = batch_scale * tf.reduce_mean(tf.reduce_sum((imgA - imgB) ** 2, axis=0))
                     elif metric == 'ssim':
                         ssim_score = tf.reduce_mean(tf.image.ssim(imgA, imgB, max_val=2.0))
                         similarity = 1 - ssim_score
                     elif (metric == 'L1_ssim') or (metric == 'ssim_L1'):
                         ssim_score = tf.reduce_mean(tf.image.ssim(imgA, imgB, max_val=2.0))
                         # similarity = tf.reduce_mean(tf.abs(imgA - imgB)) + (ssim_lambda * (1 - ssim_score))
-                        similarity = tf.reduce_mean(tf.reduce_sum(tf.abs(imgA - imgB), axis=0)) + (ssim_lambda * (1 - ssim_score))
+                        similarity = batch_scale * tf.reduce_mean(tf.reduce_sum(tf.abs(imgA - imgB), axis=0)) + (ssim_lambda * (1 - ssim_score))
                     else:
                         assert False, 'similarity loss error'
                     return similarity
@@ -393,7 +613,6 @@ class GAN(object):
                     #self.s_loss_med_style = calc_similarity(self.style_p2s, self.style_s2p, self.similarity_loss_med)
                     self.s_loss_med = calc_similarity(self.content_p2s, self.content_s2p, self.similarity_loss_med)  # L1 loss for content vector of photo and sketch
 #---------------------------
-                    self.med_lambda_p = tf.placeholder(tf.float32, name='med_lambda')
                     s_loss_sum_med = tf.summary.scalar("Col_loss", self.s_loss_med)
                     #self.s_loss_med = tf.add(self.s_loss_med, 0.5*self.s_loss_med_style)
                     self.g_loss = tf.add(self.g_loss, self.med_lambda_p * self.s_loss_med)
@@ -416,6 +635,10 @@ class GAN(object):
             if self.weight_decay != 0:
                 self.g_loss = tf.add(self.g_loss, self.weight_decay * self.g_reg, name='Gen_loss')
                 self.d_loss = tf.add(self.d_loss, self.weight_decay * self.d_reg, name='Dis_loss')
+                if self.num_replicas > 1:
+                    for tower in self.towers:
+                        tower['g_loss'] = tower['g_loss'] + self.weight_decay * self.g_reg
+                        tower['d_loss'] = tower['d_loss'] + self.weight_decay * self.d_reg
         Gen_loss_sum = tf.summary.scalar("Generator_loss", self.g_loss)
         Dis_loss_sum = tf.summary.scalar("Discriminator_loss", self.d_loss)
 
@@ -432,17 +655,134 @@ class GAN(object):
         # Optimizer
         Gen_optimizer = tf.train.AdamOptimizer(self.g_lr, beta1=self.beta1, beta2=self.beta2, name='Gen_Adam')
         Dis_optimizer = tf.train.AdamOptimizer(self.d_lr, beta1=self.beta1, beta2=self.beta2, name='Dis_Adam')
+        if self.mixed_precision is not None:
+            # dynamic loss scaling on g_loss/d_loss, updates of non-finite steps are skipped
+            Gen_optimizer, self.g_loss_scale = precision.loss_scale_optimizer(Gen_optimizer, self.mixed_precision)
+            Dis_optimizer, self.d_loss_scale = precision.loss_scale_optimizer(Dis_optimizer, self.mixed_precision)
 
         # Compute gradiants
-        Gen_grad = Gen_optimizer.compute_gradients(self.g_loss, var_list=self.Gen_vars)
-        Dis_grad = Dis_optimizer.compute_gradients(self.d_loss, var_list=self.Dis_vars)
+        if self.num_replicas > 1:
+            # synchronized data parallel: tower gradients on their devices, averaged into one update per optimizer
+            Gen_grad = average_gradients([Gen_optimizer.compute_gradients(tower['g_loss'], var_list=self.Gen_vars,
+                                                                          colocate_gradients_with_ops=True)
+                                          for tower in self.towers])
+            Dis_grad = average_gradients([Dis_optimizer.compute_gradients(tower['d_loss'], var_list=self.Dis_vars,
+                                                                          colocate_gradients_with_ops=True)
+                                          for tower in self.towers])
+        else:
+            Gen_grad = Gen_optimizer.compute_gradients(self.g_loss, var_list=self.Gen_vars)
+            Dis_grad = Dis_optimizer.compute_gradients(self.d_loss, var_list=self.Dis_vars)
 
         # Updates
-        self.g_optim = Gen_optimizer.apply_gradients(Gen_grad, global_step=self.step)
-        self.d_optim = Dis_optimizer.apply_gradients(Dis_grad)
+        if self.accum_steps > 1:
+            # d_optim/g_optim apply the accumulated mean, accum_update adds one micro-batch
+            g_accums, g_accum, self.g_optim = self.accumulate_gradients(Gen_optimizer, Gen_grad, 'Gen_accum',
+                                                                        global_step=self.step)
+            d_accums, d_accum, self.d_optim = self.accumulate_gradients(Dis_optimizer, Dis_grad, 'Dis_accum')
+            self.accum_zero = zero_variables(g_accums + d_accums, name='accum_zero')
+            # per network ('g', 'd'): add one micro-batch / apply the mean, then clear the accumulators
+            self.accum_update = {'g': g_accum, 'd': d_accum}
+            with tf.control_dependencies([self.g_optim]):
+                g_apply = zero_variables(g_accums, name='Gen_accum_apply')
+            with tf.control_dependencies([self.d_optim]):
+                d_apply = zero_variables(d_accums, name='Dis_accum_apply')
+            self.accum_apply = {'g': g_apply, 'd': d_apply}
+        else:
+            self.g_optim = Gen_optimizer.apply_gradients(Gen_grad, global_step=self.step)
+            self.d_optim = Dis_optimizer.apply_gradients(Dis_grad)
+        self.optims = {'g': self.g_optim, 'd': self.d_optim}
+
+        return
 
+    def accumulate_gradients(self, optimizer, grads_and_vars, name, global_step=None):
+        # one accumulator per variable (local, not saved in checkpoints)
+        # returns (accumulators, accumulate op, apply op of the mean over accum_steps micro-batches)
+        grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+        accums = []
+        with tf.variable_scope(name):
+            for grad, var in grads_and_vars:
+                accums.append(tf.get_local_variable(var.op.name, shape=var.get_shape(), dtype=tf.float32,
+                                                    initializer=tf.zeros_initializer()))
+        accumulate = tf.group(*[accum.assign_add(grad) for accum, (grad, _) in zip(accums, grads_and_vars)])
+        apply = optimizer.apply_gradients([(accum / float(self.accum_steps), var)
+                                           for accum, (_, var) in zip(accums, grads_and_vars)], global_step=global_step)
+        return accums, accumulate, apply
+
+    def accumulate_step(self, sess, fetches, feed_dict, options=None, run_metadata=None, updates=('d', 'g')):
+        # one batch_size update of the networks in updates as accum_steps micro-batches
+        # scalars are averaged over the micro-batches, other fetches are from the last one
+        # options/run_metadata (step trace) apply to the last micro-batch
+        results = []
+        accum_update = [self.accum_update[u] for u in updates]
+        for k in range(self.accum_steps):
+            last = (k + 1 == self.accum_steps)
+            results.append(sess.run(dict(fetches, accum_update=accum_update), feed_dict=feed_dict,
+                                    options=options if last else None, run_metadata=run_metadata if last else None))
+        sess.run([self.accum_apply[u] for u in updates], feed_dict=feed_dict)
+        for r in results:
+            r.pop('accum_update')
+        result = results[-1]
+        for key in result:
+            if (result[key] is not None) and (np.ndim(result[key]) == 0) and isinstance(result[key], numbers.Number):
+                result[key] = np.mean([r[key] for r in results])
+        return result
+
+    def build_summary(self):
+        # merged summary of summary_mode; 'scalar' leaves out image/histogram summaries
+        if self.summary_mode == 'none':
+            self.merged_summary = None
+        elif self.summary_mode == 'scalar':
+            summaries = [summary for summary in tf.get_collection(tf.GraphKeys.SUMMARIES)
+                         if summary.op.type == 'ScalarSummary']
+            self.merged_summary = tf.summary.merge(summaries) if summaries else None
+        elif self.summary_mode in ['fused', 'separate']:
+            self.merged_summary = tf.summary.merge_all()
+        else:
+            assert False, 'Wrong summary mode'
         return
 
+    def train_step(self, sess, step, fetches, feed_dict, options=None, run_metadata=None):
+        # one training step: the runs of update_plan, each of accum_steps micro-batches
+        # fetches, the summary (summary steps) and options/run_metadata go with the last run
+        # ('separate' summary: an extra run on the next batch, as before)
+        # returns (result dict, serialized summary or None)
+        summary_step = (self.merged_summary is not None) and (step % self.summary_step == 0)
+        fused = summary_step and (self.summary_mode != 'separate')
+        if fused:
+            fetches = dict(fetches, summary=self.merged_summary)
+        for k, updates in enumerate(self.update_plan):
+            last = (k + 1 == len(self.update_plan))
+            run_fetches = fetches if last else {}
+            run_options = options if last else None
+            run_metadata_k = run_metadata if last else None
+            if self.accum_steps > 1:
+                result = self.accumulate_step(sess, run_fetches, feed_dict, run_options, run_metadata_k, updates)
+            else:
+                result = sess.run(dict(run_fetches, updates=[self.optims[u] for u in updates]), feed_dict=feed_dict,
+                                  options=run_options, run_metadata=run_metadata_k)
+                result.pop('updates')
+        if fused:
+            return result, result.pop('summary')
+        if summary_step:
+            return result, sess.run(self.merged_summary, feed_dict=feed_dict)
+        return result, None
+
+    def input_functions(self):
+        # select input engine, returns (photo_sketch_batch, its kwargs, photo_batch, its kwargs)
+        dataset_args = {'num_parallel_calls': self.input_threads, 'prefetch_size': self.prefetch_size,
+                        'seed': self.input_seed}
+        if self.input_engine == 'dataset':
+            pair_args = dict(dataset_args, batch_augment=self.batch_augment)
+            return input_data.photo_sketch_batch_dataset, pair_args, input_data.photo_batch_dataset, dataset_args
+        elif self.input_engine == 'shard':
+            # shards are packed by pack_shard.py, the gallery still reads image files
+            shard_args = {'prefetch_size': self.prefetch_size, 'seed': self.input_seed}
+            return input_data.photo_sketch_batch_shard, shard_args, input_data.photo_batch_dataset, dataset_args
+        elif self.input_engine == 'queue':
+            return input_data.photo_sketch_batch_inputs, {}, input_data.photo_batch_inputs, {}
+        else:
+            assert False, 'Wrong input engine'
+
     def build_trainer(self, mode='train_gan'):
         if not os.path.exists(self.log_dir):
             os.mkdir(self.log_dir)
@@ -455,23 +795,40 @@ class GAN(object):
         # placeholder
         self.train_mode = tf.placeholder(tf.bool, name='train_mode')
 
+        # fast resume: same input seed, continue the tr/ts sample streams after the batches already consumed
+        # (dataset and shard engines; the queue engine restarts its streams)
+        self.input_skip = {'tr': 0, 'ts': 0}
+        if self.continue_training and (mode == 'train_gan'):
+            state = checkpoint.read_state(self.load_dir, self.load_epoch, 'gan')
+            if (state is not None) and (state['input_engine'] == self.input_engine != 'queue'):
+                self.input_seed = state['input_seed']
+                self.input_skip = {'tr': state['tr_batches'], 'ts': state['ts_batches']}
+                print('Resume input streams: seed %d, skip %d/%d batches'
+                      % (self.input_seed, self.input_skip['tr'], self.input_skip['ts']))
+
         # Input images
+        photo_sketch_batch_inputs, engine_args, _, _ = self.input_functions()
+        tr_args = dict(engine_args)
+        ts_args = dict(engine_args)
+        if self.input_engine != 'queue':
+            tr_args['skip_batches'] = self.input_skip['tr']
+            ts_args['skip_batches'] = self.input_skip['ts']
         # train batch
         self.tr_photo_inp, self.tr_sketch_inp, self.tr_photo_identity, self.tr_sketch_identity, self.tr_photo_name, self.tr_sketch_name, self.tr_photo_num, self.tr_sketch_num = \
-            input_data.photo_sketch_batch_inputs(self.tr_inp_dir, self.tr_txt, self.tr_txt, self.num_identity, 1,
-                                                 ['real_db'], self.batch_size, img_size=self.input_image_size,
-                                                 name='tr_inp', photo_dim=self.img_channels, sketch_dim=self.img_channels,
-                                                 flip=self.flip, crop_size=self.crop_size, padding_size=self.padding_size,
-                                                 random_crop=self.random_crop, train_mode='train_gan',
-                                                 concat_sketch_styles=True, log_dir=self.log_dir+'/tr_inputs.txt')
+            photo_sketch_batch_inputs(self.tr_inp_dir, self.tr_txt, self.tr_txt, self.num_identity, 1,
+                                      ['real_db'], self.micro_batch_size, img_size=self.input_image_size,
+                                      name='tr_inp', photo_dim=self.img_channels, sketch_dim=self.img_channels,
+                                      flip=self.flip, crop_size=self.crop_size, padding_size=self.padding_size,
+                                      random_crop=self.random_crop, train_mode='train_gan',
+                                      concat_sketch_styles=True, log_dir=self.log_dir+'/tr_inputs.txt', **tr_args)
         # test batch
         self.ts_photo_inp, self.ts_sketch_inp, self.ts_photo_identity, self.ts_sketch_identity, self.ts_photo_name, self.ts_sketch_name, self.ts_photo_num, self.ts_sketch_num = \
-            input_data.photo_sketch_batch_inputs(self.ts_inp_dir, self.ts_txt, self.ts_txt, self.num_identity, 1,
-                                                 ['real_db'], self.ts_batch_size, img_size=self.input_image_size,
-                                                 name='ts_inp', photo_dim=self.img_channels, sketch_dim=self.img_channels,
-                                                 flip=False, crop_size=self.crop_size, padding_size=self.padding_size,
-                                                 random_crop=False, train_mode='test_gan', concat_sketch_styles=True,
-                                                 log_dir=self.log_dir+'/ts_inputs.txt')
+            photo_sketch_batch_inputs(self.ts_inp_dir, self.ts_txt, self.ts_txt, self.num_identity, 1,
+                                      ['real_db'], self.ts_batch_size, img_size=self.input_image_size,
+                                      name='ts_inp', photo_dim=self.img_channels, sketch_dim=self.img_channels,
+                                      flip=False, crop_size=self.crop_size, padding_size=self.padding_size,
+                                      random_crop=False, train_mode='test_gan', concat_sketch_styles=True,
+                                      log_dir=self.log_dir+'/ts_inputs.txt', **ts_args)
 
 #-------------------------------
         self.ts_sketch_inp = tf.manip.roll (self.ts_sketch_inp, shift=2, axis=0)
@@ -521,6 +878,12 @@ class GAN(object):
         print(self.d_config, file=txtfile)
         print('use med_domain: %r' % self.med_domain, file=txtfile)
         print('discriminator method: %s' % self.discriminator_method, file=txtfile)
+        print('fuse_passes: %r (norm %s/%s)' % (self.fuse_passes, self.normG, self.normD), file=txtfile)
+        print('mixed_precision: %s' % self.mixed_precision, file=txtfile)
+        print('update schedule: %s, n_critic %d' % (self.update_schedule, self.n_critic), file=txtfile)
+        print('recompute: %r' % self.recompute, file=txtfile)
+        print('fused_adain: %r' % self.fused_adain, file=txtfile)
+        print('num_replicas: %d (%s)' % (self.num_replicas, self.replica_device), file=txtfile)
         print('similarity loss: %s' % self.similarity_loss, file=txtfile)
         print('similarity lambda: %f' % self.similarity_lambda, file=txtfile)
         print('similarity med: %s' % self.similarity_med, file=txtfile)
@@ -530,12 +893,21 @@ class GAN(object):
         print('med GAN lambda: %f' % self.med_d_lambda, file=txtfile)
         print('# Input settings=======================', file=txtfile)
         print('tr_batch_size: %d' % self.batch_size, file=txtfile)
+        if self.accum_steps > 1:
+            print('accum_steps: %d (micro batch %d)' % (self.accum_steps, self.micro_batch_size), file=txtfile)
         print('input_image_size: %d' % self.input_image_size, file=txtfile)
         print('padding_size: %d' % self.padding_size, file=txtfile)
         print('crop_size: %d' % self.crop_size, file=txtfile)
         print('random_crop: %r' % self.random_crop, file=txtfile)
         print('img_channels: %d' % self.img_channels, file=txtfile)
         print('flip: %r' % self.flip, file=txtfile)
+        print('input_engine: %s' % self.input_engine, file=txtfile)
+        if self.input_engine != 'queue':
+            print('input_threads: %d' % self.input_threads, file=txtfile)
+            print('prefetch_size: %d' % self.prefetch_size, file=txtfile)
+            print('input_seed: %s' % self.input_seed, file=txtfile)
+        if self.input_engine == 'dataset':
+            print('batch_augment: %r' % self.batch_augment, file=txtfile)
         # print('num_identity: %d' % self.num_identity, file=txtfile)
         # print('style_list: %s' % self.style_list, file=txtfile)
         print('# Trainer settings=======================', file=txtfile)
@@ -580,12 +952,21 @@ class GAN(object):
         print("epoch\td_loss\tg_loss\tadv_loss\ts_loss\tssim", file=txtfile)
         print("epoch\td_loss\tg_loss\tadv_loss\ts_loss\tssim", file=txtfile_ts)
 
+        # test metrics, averaged in the graph over a test pass
+        ts_metric_dict = {'d_loss': self.d_loss, 'g_loss': self.g_loss, 'adv_loss': self.adv_loss,
+                          's_loss': self.s_loss, 'average_ssim': self.average_ssim}
+        ts_metric_update, ts_metric_value, ts_metric_reset = streaming_means(ts_metric_dict, scope='ts_metrics')
+
         # initializer
         init_op = tf.global_variables_initializer()
         # Add ops to save and restore all the variables.
         self.saver = tf.train.Saver(max_to_keep=None)
+        self.ckpt_manager = checkpoint.CheckpointManager(self.log_dir + '/gan_ckpt', tf.global_variables(), 'gan',
+                                                         keep_last=self.ckpt_keep_last, keep_best=self.ckpt_keep_best,
+                                                         async_save=self.ckpt_async)
+        ts_ssim = None  # test SSIM of the last test pass, for keep-best retention
         # Summary
-        self.merged_summary = tf.summary.merge_all()
+        self.build_summary()
 
         # feed_dict
         if (self.med_step is None) or (self.med_step <= 0):
@@ -596,39 +977,66 @@ class GAN(object):
         feed_dict = {self.train_mode: True, self.med_lambda_p: med_lambda}
         feed_dict_ts = {self.train_mode: False, self.med_lambda_p: med_lambda}
         # fetch dict
-        tr_dict = {'d_optim': self.d_optim, 'g_optim': self.g_optim, 'd_loss': self.d_loss, 'g_loss': self.g_loss,
+        # (the optimizers are run by train_step following update_plan)
+        tr_dict = {'d_loss': self.d_loss, 'g_loss': self.g_loss,
                    'adv_loss': self.adv_loss, 's_loss': self.s_loss, 'average_ssim': self.average_ssim,
                    'photo_ssim_score': self.ssim_score_photo, 'sketch_ssim_score': self.ssim_score_sketch,
                    'name': self.photo_name, 'sk_name': self.sketch_name}
+        # per-phase wall time, queue fill (fetched with the step) and scheduled traces -> gan_profile.txt
+        step_profiler = profiler.StepProfiler(self.log_dir, self.profile_trace_every)
+        tr_dict.update(step_profiler.step_fetches())
+        # images are fetched only for sampled test batches, metrics always go through ts_metric_update
         ts_dict = {'inp_photo': self.photo_inp, 'inp_sketch': self.sketch_inp, 'gen_sketch': self.gen_sketch,
                    'gen_photo': self.gen_photo, 'med_p2s': self.gen_med_p2s, 'med_s2p': self.gen_med_s2p,
-                   'name': self.photo_name, 'sk_name': self.sketch_name, 'd_loss': self.d_loss, 'g_loss': self.g_loss, 'adv_loss': self.adv_loss,
-                   's_loss': self.s_loss,  'average_ssim': self.average_ssim, 'photo_ssim_score': self.ssim_score_photo,
-                   'sketch_ssim_score': self.ssim_score_sketch}
+                   'name': self.photo_name, 'sk_name': self.sketch_name, 'metrics': ts_metric_update}
+        ts_display_batches = sample_batches(ts_epoch, self.ts_display_batches)
+
+        # result writer
+        if self.writer_threads > 0:
+            result_writer = AsyncResultWriter(self.writer_threads, self.writer_queue)
+        else:
+            result_writer = None
+        # html report, gan_image/index.html links every display epoch
+        report = HtmlReport(self.log_dir + '/gan_image', self.display_list, self.html_rows_per_page)
 
         # ConfigProto
-        config = tf.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.allow_soft_placement = True
-        config.log_device_placement = False
+        config = self.session_config()
         # Training
         with tf.Session(config=config) as sess:
             print("Start session")
             summary_writer = tf.summary.FileWriter(self.log_dir + '/gan_summary/' + str(self.max_epoch), sess.graph)
             if self.continue_training:
-                epoch_i = self.load_epoch
-                self.saver.restore(sess, self.load_dir + "/gan-" + str(self.load_epoch))
-                print("Model restored from epoch %d." % self.load_epoch)
+                restore_time = time.time()
+                epoch_i, load_path = checkpoint.resolve(self.load_dir, self.load_epoch, 'gan')
+                self.saver.restore(sess, load_path)
+                print("Model restored from epoch %d. (%.2f sec)" % (epoch_i, time.time() - restore_time))
             else:
                 epoch_i = 0
                 sess.run(init_op)
                 print("Initialization done")
 
+            if self.accum_steps > 1:
+                sess.run(self.accum_zero)
+
             # Coordinate the loading of image files.
             coord = tf.train.Coordinator()
             threads = tf.train.start_queue_runners(coord=coord)
             print("Queue started")
 
+            # batches pulled from the tr/ts streams (every run of photo_inp pulls both through the tf.cond inputs)
+            input_batches = dict(self.input_skip)
+
+            # input throughput
+            if self.input_bench_steps > 0:
+                pairs_per_sec, bench_batches = input_data.measure_input_throughput(
+                    sess, [self.tr_photo_inp, self.tr_sketch_inp], self.micro_batch_size, self.input_bench_steps)
+                input_batches['tr'] += bench_batches  # warmup + measured batches
+                print("Input (%s): %.1f pairs/sec" % (self.input_engine, pairs_per_sec))
+                print("# input (%s): %.1f pairs/sec" % (self.input_engine, pairs_per_sec), file=txtfile)
+            first_step = True
+            step_profiler.reset()
+            schedule_time, schedule_steps = 0.0, 0  # training step throughput of the update schedule
+
             # Do training
             print("Start training")
             for i in range(epoch * epoch_i + 1, int(self.max_epoch * epoch) + 1):
@@ -642,14 +1050,27 @@ class GAN(object):
                     print("Use med_similarity now", file=txtfile)
 
                 # Update
-                tr_result = sess.run(tr_dict, feed_dict=feed_dict)
+                run_options, run_metadata = step_profiler.run_options(i)
+                step_start = time.time()
+                with step_profiler.phase('train'):
+                    tr_result, summary_str = self.train_step(sess, i, tr_dict, feed_dict, run_options, run_metadata)
+                schedule_time += time.time() - step_start
+                schedule_steps += 1
+                step_profiler.end_step(i, tr_result, run_metadata)
+                input_batches = {key: input_batches[key] + self.runs_per_step for key in input_batches}
+                if (summary_str is not None) and (self.summary_mode == 'separate'):
+                    input_batches = {key: input_batches[key] + 1 for key in input_batches}
+                if first_step:
+                    first_step = False
+                    print("Time to first step: %.2f sec" % (time.time() - self.start_time))
+                    print("# time to first step: %.2f sec" % (time.time() - self.start_time), file=txtfile)
                 assert not np.isnan(tr_result['g_loss']), 'Model diverged with g_loss = NaN'
                 assert not np.isnan(tr_result['d_loss']), 'Model diverged with d_loss = NaN'
 
                 # records
-                if i % self.summary_step == 0:
-                    summary_str = sess.run(self.merged_summary, feed_dict=feed_dict)
-                    summary_writer.add_summary(summary_str, i)
+                if summary_str is not None:
+                    with step_profiler.phase('summary'):
+                        summary_writer.add_summary(summary_str, i)
 
                 # epoch check
                 if i % epoch == 0:
@@ -663,46 +1084,70 @@ class GAN(object):
                         print("%d\t%.5f\t%.5f\t%.5f\t%.5f\t%.5f"
                               % (epoch_i, tr_result['d_loss'], tr_result['g_loss'], tr_result['adv_loss'],
                                  tr_result['s_loss'], tr_result['average_ssim']), file=txtfile)
+                        # one step: n_critic discriminator and one generator update (runs_per_step batches)
+                        print("# schedule %s n_critic %d: %.2f steps/sec, %.1f pairs/sec"
+                              % (self.update_schedule, self.n_critic, schedule_steps / schedule_time,
+                                 schedule_steps * self.runs_per_step * self.micro_batch_size / schedule_time),
+                              file=txtfile)
+                        schedule_time, schedule_steps = 0.0, 0
 
                     # visualization
                     if epoch_i % self.display_epoch == 0:
                         vis_dir = self.log_dir + '/gan_image/ep' + str(epoch_i) + '_iter' + str(i)
                         print("============================")
                         print(self.log_dir)
-                        g_loss = 0.
-                        d_loss = 0.
-                        adv_loss = 0.
-                        s_loss = 0.
-                        ssim = 0.
+                        sess.run(ts_metric_reset)
+                        report.begin(vis_dir, 'ep%d_iter%d' % (epoch_i, i))
                         for j in range(ts_epoch):
-                            ts_result = sess.run(ts_dict, feed_dict=feed_dict_ts)
+                            if j not in ts_display_batches:
+                                with step_profiler.phase('test'):
+                                    sess.run(ts_metric_update, feed_dict=feed_dict_ts)
+                                continue
+                            with step_profiler.phase('test'):
+                                ts_result = sess.run(ts_dict, feed_dict=feed_dict_ts)
                             # for k in range(len(ts_result['name'])):
                             #     assert ts_result['name'][k] == ts_result['sk_name'][k], 'Ts_inputs sequence error'
-                            visualize_results(vis_dir, ts_result, self.display_list)
-                            g_loss = g_loss + ts_result['g_loss']
-                            d_loss = d_loss + ts_result['d_loss']
-                            adv_loss = adv_loss + ts_result['adv_loss']
-                            s_loss = s_loss + ts_result['s_loss']
-                            ssim = ssim + ts_result['average_ssim']
+                            with step_profiler.phase('images'):
+                                if result_writer is not None:
+                                    result_writer.submit(vis_dir, ts_result, self.display_list)
+                                else:
+                                    visualize_results(vis_dir, ts_result, self.display_list)
+                                report.add_rows(result_names(ts_result))
+                        with step_profiler.phase('test'):
+                            ts_metric = sess.run(ts_metric_value)
+                        input_batches = {key: input_batches[key] + ts_epoch for key in input_batches}
+                        ts_ssim = float(ts_metric['average_ssim'])
                         print("%d\t%.5f\t%.5f\t%.5f\t%.5f\t%.5f"
-                              % (epoch_i, d_loss / ts_epoch, g_loss / ts_epoch, adv_loss / ts_epoch, s_loss / ts_epoch,
-                                 ssim / ts_epoch), file=txtfile_ts)
+                              % (epoch_i, ts_metric['d_loss'], ts_metric['g_loss'], ts_metric['adv_loss'],
+                                 ts_metric['s_loss'], ts_metric['average_ssim']), file=txtfile_ts)
                         print("epoch %d test|| d_loss: %.5f g_loss: %.5f adv_loss: %.5f s_loss: %.5f ssim: %.5f"
-                              % (epoch_i, d_loss / ts_epoch, g_loss / ts_epoch, adv_loss / ts_epoch, s_loss / ts_epoch,
-                                 ssim / ts_epoch))
+                              % (epoch_i, ts_metric['d_loss'], ts_metric['g_loss'], ts_metric['adv_loss'],
+                                 ts_metric['s_loss'], ts_metric['average_ssim']))
                         # display
-                        write_html(vis_dir, self.display_list)
+                        report.end()
                         print("============================")
 
                     # save model
                     if epoch_i % self.save_epoch == 0:
-                        save_path = self.saver.save(sess, self.log_dir + '/gan_ckpt/gan', global_step=epoch_i)
-                        print("Model saved in file: %s" % save_path)
+                        state = {'epoch': epoch_i, 'step': i, 'input_engine': self.input_engine,
+                                 'input_seed': self.input_seed, 'tr_batches': input_batches['tr'],
+                                 'ts_batches': input_batches['ts']}
+                        with step_profiler.phase('checkpoint'):
+                            save_path = self.ckpt_manager.save(sess, epoch_i, metric=ts_ssim, state=state)
+                        print("Model saved in file: %s (written in the background)" % save_path if self.ckpt_async
+                              else "Model saved in file: %s" % save_path)
+
+                    step_profiler.report(epoch_i)
 
             # Finish off the filename queue coordinator.
             coord.request_stop()
             coord.join(threads)
             sess.close()
+        self.ckpt_manager.close()
+        step_profiler.close()
+        if result_writer is not None:
+            result_writer.close()
+        report.close()
         txtfile.close()
         txtfile_ts.close()
 
@@ -721,14 +1166,15 @@ class GAN(object):
         self.train_mode = tf.placeholder(tf.bool, name='train_mode')
 
         # Input images
+        photo_sketch_batch_inputs, engine_args, photo_batch_inputs, gallery_args = self.input_functions()
         # test batch
         self.photo_inp, self.sketch_inp, self.photo_identity, self.sketch_identity, self.photo_name, self.sketch_name, self.photo_num, self.sketch_num = \
-            input_data.photo_sketch_batch_inputs(self.ts_inp_dir, self.ts_txt, self.ts_txt, self.num_identity, 1,
-                                                 ['real_db_s'], self.ts_batch_size, img_size=self.input_image_size,
-                                                 name='ts_inp', photo_dim=self.img_channels, sketch_dim=self.img_channels,
-                                                 flip=False, crop_size=self.crop_size, padding_size=self.padding_size,
-                                                 random_crop=False, train_mode='test_gan', concat_sketch_styles=True,
-                                                 log_dir=self.log_dir+'/ts_inputs.txt')
+            photo_sketch_batch_inputs(self.ts_inp_dir, self.ts_txt, self.ts_txt, self.num_identity, 1,
+                                      ['real_db_s'], self.ts_batch_size, img_size=self.input_image_size,
+                                      name='ts_inp', photo_dim=self.img_channels, sketch_dim=self.img_channels,
+                                      flip=False, crop_size=self.crop_size, padding_size=self.padding_size,
+                                      random_crop=False, train_mode='test_gan', concat_sketch_styles=True,
+                                      log_dir=self.log_dir+'/ts_inputs.txt', **engine_args)
 
 #------------------
         #self.tr_sketch_inp = tf.roll (self.tr_sketch_inp, shift=2, axis=0)
@@ -736,14 +1182,43 @@ class GAN(object):
         # gallery batch
         if test_gallery:
             self.gallery_inp, self.gallery_identity, self.gallery_name, self.gallery_num = \
-                input_data.photo_batch_inputs(self.ts_inp_dir + '/gallery', gallery_txt, 20000,
-                                              self.ts_batch_size, img_size=self.input_image_size, name='gallery_inp',
-                                              photo_dim=self.img_channels, flip=False, crop_size=self.crop_size,
-                                              padding_size=self.padding_size, random_crop=False,
-                                              train_mode='test_gallery',
-                                              log_dir=self.log_dir + '/ts_gallery.txt')
+                photo_batch_inputs(self.ts_inp_dir + '/gallery', gallery_txt, 20000,
+                                   self.ts_batch_size, img_size=self.input_image_size, name='gallery_inp',
+                                   photo_dim=self.img_channels, flip=False, crop_size=self.crop_size,
+                                   padding_size=self.padding_size, random_crop=False,
+                                   train_mode='test_gallery',
+                                   log_dir=self.log_dir + '/ts_gallery.txt', **gallery_args)
 
         # build network
         self.build_network(mode=mode, test_gallery=test_gallery)
 
         return
+
+    def gallery_features(self, sess, ckpt_path, gallery_txt, gallery_dir=None):
+        # gallery_feature of every gallery image in gallery_txt order, (features, identities, names)
+        # from the gallery cache of ckpt_path; only new or changed images are encoded, fed through gallery_inp
+        if gallery_dir is None:
+            gallery_dir = self.ts_inp_dir + '/gallery'
+        filedirs, names, identities = input_data.read_dirs_with_txt([gallery_dir], gallery_txt, 0)
+        cache_dir = self.gallery_cache_dir if self.gallery_cache_dir else self.log_dir + '/gallery_cache'
+        # the features also depend on the pooling grid and on the load_test_image preprocessing
+        params = {'gallery_grid': self.gallery_grid, 'img_size': self.input_image_size, 'channels': self.img_channels,
+                  'padding_size': self.padding_size, 'crop_size': self.crop_size, 'preprocess': 'load_test_image'}
+        cache = gallery_cache.GalleryFeatureCache(cache_dir, gallery_cache.checkpoint_hash(ckpt_path), params)
+        missing = cache.missing(filedirs)
+        print('gallery: %d images, %d cached, %d to encode' % (len(filedirs), len(filedirs) - len(missing),
+                                                                len(missing)))
+        batch_size = self.gallery_inp.get_shape().as_list()[0] or self.ts_batch_size
+        features = []
+        for start in range(0, len(missing), batch_size):
+            images = np.stack([load_test_image(f, self.input_image_size, self.img_channels, self.padding_size,
+                                               self.crop_size) for f in missing[start:start + batch_size]])
+            num = len(images)
+            if num < batch_size:
+                images = np.concatenate([images, np.repeat(images[-1:], batch_size - num, axis=0)], axis=0)
+            feature = sess.run(self.gallery_feature, feed_dict={self.gallery_inp: images, self.train_mode: False})
+            features.append(feature[0:num])
+        if missing:
+            # one cache write per evaluation (each write rewrites features.npy)
+            cache.update(missing, np.concatenate(features, axis=0))
+        return cache.lookup(filedirs), np.array(identities), names
@@ -0,0 +1,274 @@
+# Batched photo <-> sketch translation from a gan_ckpt checkpoint
+# builds one direction only: content encoder + style encoder + AdaIN + decoder (no discriminators, no losses)
+# fixed target style: translate_style() feeds cached style statistics, the style encoder is not run
+import os
+import time
+import argparse
+import collections
+import numpy as np
+import tensorflow as tf
+
+import model
+import options
+import gan_share
+from utils import *
+
+
+# direction -> (content encoder, style encoder, decoder) scopes, as named in GAN.build_network
+DIRECTION_SCOPES = {'p2s': ('Gen_p2s_A_', 'Gen_s2p_A_', 'Gen_p2s_B_'),
+                    's2p': ('Gen_s2p_A_', 'Gen_p2s_A_', 'Gen_s2p_B_')}
+
+
+class StyleCache(object):
+    # LRU cache of per-style AdaIN statistics: key -> (mean, sigma), float32 [C] each
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Translator(object):
+    def __init__(self, ckpt_path, direction='p2s', enc_model='col_gen_enc', dec_model='col_gen_dec', med_channels=256,
+                 norm='batch_instance', img_channels=3, batch_size=8, img_size=272, padding_size=272, crop_size=256,
+                 gpu_memory_growth=True, fixed_mode=False, style_cache_size=16):
+        assert direction in DIRECTION_SCOPES, 'Translator: wrong direction'
+        self.ckpt_path = ckpt_path
+        self.direction = direction
+        self.enc_model = enc_model
+        self.dec_model = dec_model
+        self.med_channels = med_channels
+        self.norm = norm
+        self.img_channels = img_channels
+        self.batch_size = batch_size
+        self.img_size = img_size
+        self.padding_size = padding_size
+        self.crop_size = crop_size
+        self.fixed_mode = fixed_mode  # train_mode as a constant (for export), not a placeholder
+        self.latencies = []
+        self.style_cache = StyleCache(style_cache_size)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.build()
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = gpu_memory_growth
+            config.allow_soft_placement = True
+            self.sess = tf.Session(graph=self.graph, config=config)
+            # restore only the variables of this direction
+            saver = tf.train.Saver(var_list=tf.global_variables())
+            saver.restore(self.sess, ckpt_path)
+        print("Translator (%s) restored from %s" % (direction, ckpt_path))
+
+    def build(self):
+        content_scope, style_scope, decoder_scope = DIRECTION_SCOPES[self.direction]
+        encoder, self.enc_config = gan_share.config_network(self.enc_model, self.norm, output_channels=self.med_channels,
+                                                            output_activation=None)
+        decoder, self.dec_config = gan_share.config_network(self.dec_model, self.norm, output_channels=self.img_channels,
+                                                            output_activation='tanh')
+        shape = [self.batch_size, self.crop_size, self.crop_size, self.img_channels]
+        if self.fixed_mode:
+            self.train_mode = tf.constant(False, name='train_mode')
+        else:
+            self.train_mode = tf.placeholder_with_default(False, [], name='train_mode')
+        self.content_inp = tf.placeholder(tf.float32, shape, name='content_inp')
+        self.style_inp = tf.placeholder(tf.float32, shape, name='style_inp')
+
+        self.content_med = encoder(self.content_inp, self.enc_config, self.train_mode, name=content_scope, reuse=False)
+        self.style_med = encoder(self.style_inp, self.enc_config, self.train_mode, name=style_scope, reuse=False)
+        # style statistics of style_inp unless fed (translate_style), feeding them prunes the style encoder
+        style_mean, style_sigma = model.style_statistics(self.style_med)
+        stat_shape = [self.batch_size, 1, 1, self.med_channels]
+        self.style_mean = tf.placeholder_with_default(style_mean, stat_shape, name='style_mean')
+        self.style_sigma = tf.placeholder_with_default(style_sigma, stat_shape, name='style_sigma')
+        self.gen_med = model.AdaIN_statistics(self.content_med, self.style_mean, self.style_sigma)
+        self.output = decoder(self.gen_med, self.dec_config, self.train_mode, name=decoder_scope, reuse=False)
+        self.output = tf.identity(self.output, name='output')
+        return
+
+    def pad_batch(self, images):
+        # fixed batch size graph: repeat the last image, caller trims the outputs
+        num = len(images)
+        assert 0 < num <= self.batch_size, 'Translator: batch size error'
+        if num < self.batch_size:
+            images = np.concatenate([images, np.repeat(images[-1:], self.batch_size - num, axis=0)], axis=0)
+        return images
+
+    def translate(self, content, style):
+        # content, style: float32 [N, crop, crop, C] in [-1, 1]; style may be one image for the whole batch
+        num = len(content)
+        if len(style) == 1:
+            style = np.repeat(style, num, axis=0)
+        outputs = []
+        for start in range(0, num, self.batch_size):
+            content_batch = self.pad_batch(content[start:start + self.batch_size])
+            style_batch = self.pad_batch(style[start:start + self.batch_size])
+            start_time = time.time()
+            output = self.sess.run(self.output, feed_dict={self.content_inp: content_batch, self.style_inp: style_batch})
+            self.latencies.append(time.time() - start_time)
+            outputs.append(output[0:min(self.batch_size, num - start)])
+        return np.concatenate(outputs, axis=0)
+
+    def style_statistics(self, style):
+        # (mean, sigma) [C] of a target style, averaged over its reference images [N, crop, crop, C]
+        assert self.style_mean is not None, 'Translator: graph has no style_mean/style_sigma, re-export it'
+        means = []
+        sigmas = []
+        for start in range(0, len(style), self.batch_size):
+            num = min(self.batch_size, len(style) - start)
+            style_batch = self.pad_batch(style[start:start + self.batch_size])
+            mean, sigma = self.sess.run([self.style_mean, self.style_sigma], feed_dict={self.style_inp: style_batch})
+            means.append(mean[0:num])
+            sigmas.append(sigma[0:num])
+        return np.concatenate(means).mean(axis=(0, 1, 2)), np.concatenate(sigmas).mean(axis=(0, 1, 2))
+
+    def cache_style(self, key, style):
+        value = self.style_statistics(style)
+        self.style_cache.put(key, value)
+        return value
+
+    def translate_style(self, content, key, style=None):
+        # translate content into the cached style key (content encoder + decoder only)
+        # style: reference images for the statistics on a cache miss
+        assert self.style_mean is not None, 'Translator: graph has no style_mean/style_sigma, re-export it'
+        value = self.style_cache.get(key)
+        if value is None:
+            assert style is not None, 'Translator: style %r is not cached' % (key,)
+            value = self.cache_style(key, style)
+        mean = np.tile(value[0].reshape(1, 1, 1, -1), [self.batch_size, 1, 1, 1])
+        sigma = np.tile(value[1].reshape(1, 1, 1, -1), [self.batch_size, 1, 1, 1])
+        num = len(content)
+        outputs = []
+        for start in range(0, num, self.batch_size):
+            content_batch = self.pad_batch(content[start:start + self.batch_size])
+            start_time = time.time()
+            output = self.sess.run(self.output, feed_dict={self.content_inp: content_batch, self.style_mean: mean,
+                                                           self.style_sigma: sigma})
+            self.latencies.append(time.time() - start_time)
+            outputs.append(output[0:min(self.batch_size, num - start)])
+        return np.concatenate(outputs, axis=0)
+
+    def load_files(self, filedirs):
+        return np.stack([load_test_image(f, self.img_size, self.img_channels, self.padding_size, self.crop_size)
+                         for f in filedirs])
+
+    def translate_files(self, content_files, style_files):
+        return self.translate(self.load_files(content_files), self.load_files(style_files))
+
+    def report(self, skip=1):
+        # per-batch latency and throughput, the first batch(es) include graph warm-up
+        latencies = np.array(self.latencies[skip:] if len(self.latencies) > skip else self.latencies)
+        result = {'batches': len(latencies), 'batch_size': self.batch_size,
+                  'latency_mean_ms': 1000 * latencies.mean(), 'latency_p50_ms': 1000 * np.percentile(latencies, 50),
+                  'latency_p95_ms': 1000 * np.percentile(latencies, 95),
+                  'images_per_sec': self.batch_size / latencies.mean()}
+        print("%s: %d batches of %d, latency mean %.2f ms p50 %.2f ms p95 %.2f ms, %.1f images/sec"
+              % (self.direction, result['batches'], self.batch_size, result['latency_mean_ms'],
+                 result['latency_p50_ms'], result['latency_p95_ms'], result['images_per_sec']))
+        return result
+
+    def close(self):
+        self.sess.close()
+
+
+class FrozenTranslator(Translator):
+    # same interface as Translator, served from a graph written by export_graph.py
+    def __init__(self, graph_path, direction='p2s', batch_size=8, img_channels=3, img_size=272, padding_size=272,
+                 crop_size=256, gpu_memory_growth=True, style_cache_size=16):
+        self.direction = direction
+        self.batch_size = batch_size
+        self.img_channels = img_channels
+        self.img_size = img_size
+        self.padding_size = padding_size
+        self.crop_size = crop_size
+        self.latencies = []
+        self.style_cache = StyleCache(style_cache_size)
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+            self.content_inp = self.graph.get_tensor_by_name('content_inp:0')
+            self.style_inp = self.graph.get_tensor_by_name('style_inp:0')
+            self.output = self.graph.get_tensor_by_name('output:0')
+            # style statistics (translate_style), kept as outputs by export_graph.py; None for older exports
+            try:
+                self.style_mean = self.graph.get_tensor_by_name('style_mean:0')
+                self.style_sigma = self.graph.get_tensor_by_name('style_sigma:0')
+            except KeyError:
+                self.style_mean = None
+                self.style_sigma = None
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = gpu_memory_growth
+            config.allow_soft_placement = True
+            self.sess = tf.Session(graph=self.graph, config=config)
+        assert self.content_inp.get_shape().as_list()[0] == batch_size, 'FrozenTranslator: batch size error'
+        print("Translator (%s) loaded from %s" % (direction, graph_path))
+
+
+def read_list(list_txt):
+    # first column of a list file (same format as tr_list.txt)
+    filenames = []
+    with open(list_txt, 'r') as f:
+        for line in f:
+            line = line.split()
+            if line:
+                filenames.append(line[0])
+    return filenames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', type=str, default='record/step0/gan_ckpt/gan-5000')
+    parser.add_argument('--direction', type=str, default='p2s')  # p2s, s2p
+    parser.add_argument('--content_dir', type=str, default="../data/synthesis/DB272prip/photo")
+    parser.add_argument('--content_list', type=str, default="../data/synthesis/DB272prip/ts_list.txt")
+    parser.add_argument('--style_file', type=str, default="../data/synthesis/DB272prip/real_db/00001.png")
+    parser.add_argument('--cached_style', type=options.str2bool, default=False)  # style statistics once, style encoder skipped
+    parser.add_argument('--out_dir', type=str, default='record/inference')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--g_enc_model', type=str, default='col_gen_enc')
+    parser.add_argument('--g_dec_model', type=str, default='col_gen_dec')
+    parser.add_argument('--med_channels', type=int, default=256)
+    parser.add_argument('--img_size', type=int, default=272)
+    config = parser.parse_args()
+
+    translator = Translator(config.ckpt, config.direction, config.g_enc_model, config.g_dec_model, config.med_channels,
+                            batch_size=config.batch_size, img_size=config.img_size)
+    names = read_list(config.content_list)
+    # --style_file may list several references of one style, comma separated
+    style = translator.load_files(config.style_file.split(','))
+    if not os.path.exists(config.out_dir):
+        os.mkdir(config.out_dir)
+    for start in range(0, len(names), config.batch_size):
+        batch_names = names[start:start + config.batch_size]
+        content = translator.load_files([config.content_dir + '/' + n for n in batch_names])
+        if config.cached_style:
+            output = translator.translate_style(content, config.style_file, style)
+        else:
+            output = translator.translate(content, style)
+        save_examples(output, config.out_dir + '/' + config.direction, [os.path.splitext(n)[0] for n in batch_names])
+    translator.report()
+    translator.close()
@@ -1,4 +1,5 @@
 import os
+import time
 import numpy as np
 import tensorflow as tf
 import random
@@ -258,14 +259,18 @@ def load_photo(input_dir, photo_txt, queue_capacity, img_size, photo_dim=1, flip
 
 def photo_sketch_batch_inputs(input_dir, photo_txt, sketch_txt, num_identity, num_style, style_list, batch_size,
                               img_size=256, name='', photo_dim=3, sketch_dim=3, flip=False, crop_size=None,
-                              padding_size=None, random_crop=False, train_mode='train_gan', concat_sketch_styles=False, log_dir=None):
+                              padding_size=None, random_crop=False, train_mode='train_gan', concat_sketch_styles=False, log_dir=None,
+                              num_threads=1, queue_capacity=None):
+    # num_threads: batching threads, queue_capacity: None for 16 * batch_size (train) / 4 * batch_size (test)
     with tf.device('/cpu:0'):
         if train_mode == 'test_gan':
-            queue_capacity = 4 * batch_size
+            default_capacity = 4 * batch_size
         elif train_mode == 'train_gan':
-            queue_capacity = 16 * batch_size
+            default_capacity = 16 * batch_size
         else:
             assert False, 'input_data: train_mode Error'
+        if queue_capacity is None:
+            queue_capacity = default_capacity
 
         # load images and preprocessing
         # photo dir = input_dir+'/photo'
@@ -288,11 +293,11 @@ def photo_sketch_batch_inputs(input_dir, photo_txt, sketch_txt, num_identity, nu
             if concat_sketch_styles:
                 photo_batch, photo_identity_batch, photo_name_batch, sketch_batch, sketch_identity_batch, sketch_name_batch = \
                     tf.train.shuffle_batch([photos, photo_identity, photo_names, sketches, sketch_identity, sketch_names],
-                                           batch_size=batch_size, num_threads=1, capacity=queue_capacity,
+                                           batch_size=batch_size, num_threads=num_threads, capacity=queue_capacity,
                                            min_after_dequeue=int(queue_capacity/2), seed=seed, name=name+'batch_queue')
             else:
                 tmp_batches = tf.train.shuffle_batch([photos, photo_identity, photo_names, sketch_names] + sketches + sketch_identity,
-                                                     batch_size=batch_size, num_threads=1, capacity=queue_capacity,
+                                                     batch_size=batch_size, num_threads=num_threads, capacity=queue_capacity,
                                                      min_after_dequeue=int(queue_capacity/2), seed=seed, name=name+'batch_queue')
                 photo_batch = tmp_batches[0]
                 photo_identity_batch = tmp_batches[1]
@@ -304,11 +309,11 @@ def photo_sketch_batch_inputs(input_dir, photo_txt, sketch_txt, num_identity, nu
             if concat_sketch_styles:
                 photo_batch, photo_identity_batch, photo_name_batch, sketch_batch, sketch_identity_batch, sketch_name_batch = \
                     tf.train.batch([photos, photo_identity, photo_names, sketches, sketch_identity, sketch_names],
-                                   batch_size=batch_size, num_threads=1, capacity=queue_capacity,
+                                   batch_size=batch_size, num_threads=num_threads, capacity=queue_capacity,
                                    name=name+'batch_queue')
             else:
                 tmp_batches = tf.train.batch([photos, photo_identity, photo_names, sketch_names] + sketches + sketch_identity,
-                                             batch_size=batch_size, num_threads=1, capacity=queue_capacity,
+                                             batch_size=batch_size, num_threads=num_threads, capacity=queue_capacity,
                                              name=name+'batch_queue')
                 photo_batch = tmp_batches[0]
                 photo_identity_batch = tmp_batches[1]
@@ -388,3 +393,413 @@ def photo_batch_inputs(input_dir, photo_txt, num_identity, batch_size, img_size=
         '''
 
         return photo_batch, photo_identity_batch, photo_name_batch, photo_num
+
+
+# tf.data engine ----------------------------------------------------------------------------------------------------
+def preprocess_stateless(images, channels, seed, img_size=128, flip=False, crop_size=None, random_crop=False,
+                         padding_size=None):
+    # same as preprocess(), but all images get one crop/flip drawn from a per-element stateless seed,
+    # so photo and sketch stay aligned under a parallel map
+    with tf.device('/cpu:0'):
+        image = tf.concat([tf.to_float(img) for img in images], axis=2)
+        image = tf.subtract(image, 127.5)
+        image = tf.divide(image, 127.5)
+        depth = sum(channels)
+        size = img_size
+        # padding
+        if (padding_size != None) and (padding_size != False) and (padding_size != img_size):
+            image = tf.image.resize_image_with_crop_or_pad(image, padding_size, padding_size)
+            size = padding_size
+        rand = tf.contrib.stateless.stateless_random_uniform([3], seed=seed)
+        # crop
+        if (crop_size != None) and (crop_size != False) and (crop_size != padding_size):
+            if random_crop:
+                offset = tf.to_int32(tf.floor(rand[0:2] * (size - crop_size + 1)))
+                offset = tf.minimum(offset, size - crop_size)
+                image = tf.slice(image, tf.stack([offset[0], offset[1], 0]), [crop_size, crop_size, depth])
+            else:
+                image = tf.image.resize_image_with_crop_or_pad(image, crop_size, crop_size)
+            image.set_shape([crop_size, crop_size, depth])
+        # flip
+        if flip == True:
+            image = tf.cond(rand[2] < 0.5, lambda: tf.reverse(image, [1]), lambda: image)
+        return tf.split(image, channels, axis=2)
+
+
+def decode_file(filedir, img_size, channel=3):
+    image = tf.image.decode_image(tf.read_file(filedir), channels=channel)
+    image.set_shape([img_size, img_size, channel])
+    return image
+
+
+def augment_pair_batch(photo, sketch, crop_size=None, flip=False, random_crop=False, seed=None):
+    # crop + flip whole photo/sketch batches with a single gather_nd
+    # both share one index grid, so they stay exactly aligned without relying on op seeds
+    # seed: int, or int64 [2] per-batch stateless seed (make_dataset batch_map_func); crop and flip draw from
+    # two seeds derived from it, so the flips do not repeat the crop offsets
+    with tf.device('/cpu:0'):
+        photo_dim = photo.get_shape().as_list()[3]
+        image = tf.concat([photo, sketch], axis=3)
+        batch, size, _, depth = image.get_shape().as_list()
+        if (crop_size == None) or (crop_size == False):
+            crop_size = size
+        if seed == None:
+            seed = random.randint(0, 2**31 - 1)
+        if isinstance(seed, int):
+            seed = [seed, 0]
+        seed = tf.cast(seed, tf.int64)
+        crop_seed = tf.stack([seed[0], 2 * seed[1]])
+        flip_seed = tf.stack([seed[0], 2 * seed[1] + 1])
+        # window offsets
+        if random_crop:
+            rand = tf.contrib.stateless.stateless_random_uniform([batch, 2], seed=crop_seed)
+            offset = tf.minimum(tf.to_int32(tf.floor(rand * (size - crop_size + 1))), size - crop_size)
+        else:
+            offset = tf.fill([batch, 2], (size - crop_size) // 2)
+        steps = tf.range(crop_size)
+        rows = offset[:, 0:1] + steps
+        cols = offset[:, 1:2] + steps
+        # flip: read columns backwards
+        if flip == True:
+            flipped = tf.less(tf.contrib.stateless.stateless_random_uniform([batch], seed=flip_seed), 0.5)
+            cols = tf.where(flipped, tf.reverse(cols, [1]), cols)
+        # (b, y, x) gather indices
+        b_idx = tf.tile(tf.reshape(tf.range(batch), [batch, 1, 1]), [1, crop_size, crop_size])
+        y_idx = tf.tile(tf.expand_dims(rows, 2), [1, 1, crop_size])
+        x_idx = tf.tile(tf.expand_dims(cols, 1), [1, crop_size, 1])
+        image = tf.gather_nd(image, tf.stack([b_idx, y_idx, x_idx], axis=3))
+        image.set_shape([batch, crop_size, crop_size, depth])
+        photo, sketch = tf.split(image, [photo_dim, depth - photo_dim], axis=3)
+        return photo, sketch
+
+
+def make_dataset(columns, map_func, batch_size, shuffle_size=0, num_parallel_calls=4, prefetch_size=2, seed=0,
+                 batch_map_func=None, skip=0):
+    # columns -> (shuffle) -> repeat -> parallel map(element, element_seed) -> batch -> (batch map(batch, batch_seed))
+    # -> prefetch
+    # shuffling is done on file names, so the shuffle buffer never holds decoded images
+    # skip: elements dropped before the map (resume), cheap because nothing is decoded yet
+    dataset = tf.data.Dataset.from_tensor_slices(columns)
+    if shuffle_size > 0:
+        dataset = dataset.shuffle(shuffle_size, seed=seed)
+    dataset = dataset.repeat()
+    # element counter -> stateless seed, so augmentation does not depend on map scheduling
+    dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.range(2**62)))
+    if skip > 0:
+        dataset = dataset.skip(skip)
+    base_seed = tf.constant(seed, dtype=tf.int64)
+    dataset = dataset.map(lambda element, count: map_func(element, tf.stack([base_seed, count])),
+                          num_parallel_calls=num_parallel_calls)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    if batch_map_func is not None:
+        # batch counter -> stateless seed, counted from the first batch after skip (resume gives the same seeds)
+        dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.range(skip // batch_size, 2**62)))
+        dataset = dataset.map(lambda batch, count: batch_map_func(batch, tf.stack([base_seed, count])),
+                              num_parallel_calls=num_parallel_calls)
+    if prefetch_size > 0:
+        dataset = dataset.prefetch(prefetch_size)
+    return dataset
+
+
+def write_input_log(log_dir, photo_filedirs, photo_num, sketch_filedirs=None, sketch_num=None):
+    txtfile = open(log_dir, 'w')
+    print('#photos=============================================', file=txtfile)
+    print('number of photos: %d' % photo_num, file=txtfile)
+    for k in range(len(photo_filedirs)):
+        print(photo_filedirs[k], file=txtfile)
+    if sketch_filedirs is not None:
+        print('#sketches===========================================', file=txtfile)
+        print('number of sketches: %d' % sketch_num, file=txtfile)
+        for k in range(len(sketch_filedirs)):
+            print(sketch_filedirs[k], file=txtfile)
+    txtfile.close()
+
+
+def photo_sketch_batch_dataset(input_dir, photo_txt, sketch_txt, num_identity, num_style, style_list, batch_size,
+                               img_size=256, name='', photo_dim=3, sketch_dim=3, flip=False, crop_size=None,
+                               padding_size=None, random_crop=False, train_mode='train_gan', concat_sketch_styles=False,
+                               log_dir=None, num_parallel_calls=4, prefetch_size=2, seed=None, batch_augment=False,
+                               skip_batches=0):
+    # drop-in for photo_sketch_batch_inputs (same returns), built on tf.data instead of queue runners
+    # batch_augment: decode/pad per element, then crop/flip whole batches with augment_pair_batch
+    # skip_batches: continue the sample stream of the same seed after that many batches (resume)
+    with tf.device('/cpu:0'):
+        if train_mode == 'test_gan':
+            shuffle_size = 0
+            flip = False
+            random_crop = False
+            num_identity = None
+        elif train_mode == 'train_gan':
+            shuffle_size = 16 * batch_size
+        else:
+            assert False, 'input_data: train_mode Error'
+        if seed == None:
+            seed = random.randint(0, 2**31 - 1)
+
+        photo_dir = [input_dir+'/photo']
+        print(photo_dir)
+        assert num_style == len(style_list), 'number of style error'
+        sketch_dirs = []
+        for i in range(num_style):
+            sketch_dirs.append(input_dir+'/'+style_list[i])
+        print(sketch_dirs)
+
+        # read photo/sketch directories
+        photo_filedirs, photo_filenames, photo_identities = read_dirs_with_txt(photo_dir, photo_txt, 0, num_label=num_identity)
+        photo_num = len(photo_filedirs)
+        print('number of photo: %d' % photo_num)
+        sketch_filedirs, sketch_filenames, sketch_identities = read_dirs_with_txt(sketch_dirs, sketch_txt, num_style, concat_sketch_styles, num_label=num_identity)
+        if concat_sketch_styles:
+            sketch_num = len(sketch_filedirs)
+            sketch_filedirs = [sketch_filedirs]
+            sketch_identities = [sketch_identities]
+        else:
+            sketch_num = num_style*len(sketch_filedirs[0])
+        print('number of sketch: %d' % sketch_num)
+        if log_dir != None:
+            write_input_log(log_dir, photo_filedirs, photo_num, sketch_filedirs, sketch_num)
+
+        if batch_augment:
+            assert concat_sketch_styles, 'input_data: batch_augment needs concat_sketch_styles'
+            element_args = (img_size, False, None, False, padding_size)
+        else:
+            element_args = (img_size, flip, crop_size, random_crop, padding_size)
+
+        def load_element(element, element_seed):
+            photo_filedir, photo_identity, photo_name, sketch_name, sketch_filedir, sketch_identity = element
+            images = [decode_file(photo_filedir, img_size, photo_dim)]
+            for i in range(len(sketch_filedir)):
+                images.append(decode_file(sketch_filedir[i], img_size, sketch_dim))
+            images = preprocess_stateless(images, [photo_dim] + [sketch_dim]*len(sketch_filedir), element_seed,
+                                          *element_args)
+            return images[0], photo_identity, photo_name, sketch_name, tuple(images[1:]), sketch_identity
+
+        def augment_batch(batch, batch_seed):
+            photo, photo_identity, photo_name, sketch_name, sketch, sketch_identity = batch
+            photo, sketch_0 = augment_pair_batch(photo, sketch[0], crop_size, flip, random_crop, batch_seed)
+            return photo, photo_identity, photo_name, sketch_name, (sketch_0,), sketch_identity
+
+        columns = (tf.convert_to_tensor(photo_filedirs, dtype=tf.dtypes.string),
+                   tf.convert_to_tensor(photo_identities, dtype=tf.dtypes.int32),
+                   tf.convert_to_tensor(photo_filenames, dtype=tf.dtypes.string),
+                   tf.convert_to_tensor(sketch_filenames, dtype=tf.dtypes.string),
+                   tuple([tf.convert_to_tensor(dirs, dtype=tf.dtypes.string) for dirs in sketch_filedirs]),
+                   tuple([tf.convert_to_tensor(ids, dtype=tf.dtypes.int32) for ids in sketch_identities]))
+
+        with tf.name_scope(name+'dataset'):
+            dataset = make_dataset(columns, load_element, batch_size, shuffle_size, num_parallel_calls, prefetch_size, seed,
+                                   batch_map_func=augment_batch if batch_augment else None,
+                                   skip=skip_batches * batch_size)
+            iterator = dataset.make_one_shot_iterator()
+            photo_batch, photo_identity_batch, photo_name_batch, sketch_name_batch, sketch_batch, sketch_identity_batch = \
+                iterator.get_next()
+
+        sketch_batch = list(sketch_batch)
+        sketch_identity_batch = list(sketch_identity_batch)
+        if concat_sketch_styles:
+            sketch_batch = sketch_batch[0]
+            sketch_identity_batch = sketch_identity_batch[0]
+
+        return photo_batch, sketch_batch, photo_identity_batch, sketch_identity_batch, photo_name_batch, sketch_name_batch, photo_num, sketch_num
+
+
+def photo_batch_dataset(input_dir, photo_txt, num_identity, batch_size, img_size=256, name='', photo_dim=3, flip=False,
+                        crop_size=None, padding_size=None, random_crop=False, train_mode='test_gallery', log_dir=None,
+                        num_parallel_calls=4, prefetch_size=2, seed=None):
+    # drop-in for photo_batch_inputs (same returns), built on tf.data instead of queue runners
+    with tf.device('/cpu:0'):
+        if train_mode != 'test_gallery':
+            assert False, 'input_data: photo train_mode Error'
+        if seed == None:
+            seed = random.randint(0, 2**31 - 1)
+
+        photo_dir = [input_dir]
+        print(photo_dir)
+        photo_filedirs, photo_filenames, photo_identities = read_dirs_with_txt(photo_dir, photo_txt, 0, num_label=num_identity)
+        photo_num = len(photo_filedirs)
+        print('number of photo: %d' % photo_num)
+        if log_dir != None:
+            write_input_log(log_dir, photo_filedirs, photo_num)
+
+        def load_element(element, element_seed):
+            photo_filedir, photo_identity, photo_name = element
+            photo = decode_file(photo_filedir, img_size, photo_dim)
+            photo = preprocess_stateless([photo], [photo_dim], element_seed, img_size, False, crop_size, False,
+                                         padding_size)[0]
+            return photo, photo_identity, photo_name
+
+        columns = (tf.convert_to_tensor(photo_filedirs, dtype=tf.dtypes.string),
+                   tf.convert_to_tensor(photo_identities, dtype=tf.dtypes.int32),
+                   tf.convert_to_tensor(photo_filenames, dtype=tf.dtypes.string))
+
+        with tf.name_scope(name+'dataset'):
+            dataset = make_dataset(columns, load_element, batch_size, 0, num_parallel_calls, prefetch_size, seed)
+            iterator = dataset.make_one_shot_iterator()
+            photo_batch, photo_identity_batch, photo_name_batch = iterator.get_next()
+
+        return photo_batch, photo_identity_batch, photo_name_batch, photo_num
+
+
+def measure_input_throughput(sess, batch, batch_size, num_batches=100, warmup=10):
+    # (photo/sketch pairs per second the input graph delivers on its own (no training step), batches pulled)
+    # queue runners (queue engine) must already be started on sess
+    for _ in range(warmup):
+        sess.run(batch)
+    start_time = time.time()
+    for _ in range(num_batches):
+        sess.run(batch)
+    elapsed = time.time() - start_time
+    return num_batches * batch_size / elapsed, warmup + num_batches
+
+
+# pre-decoded memory-mapped shards ----------------------------------------------------------------------------------
+# <shard_dir>/photo.npy, sketch.npy: uint8 [N, H, W, C] (np.load with mmap_mode='r')
+# <shard_dir>/identity.npy: int32 [N], <shard_dir>/names.txt: one image name per line
+def shard_path(input_dir, list_txt, style):
+    list_name = os.path.splitext(os.path.basename(list_txt))[0]
+    return input_dir + '/shard_' + list_name + '_' + style
+
+
+class PhotoSketchShard(object):
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.photo = np.load(shard_dir + '/photo.npy', mmap_mode='r')
+        self.sketch = np.load(shard_dir + '/sketch.npy', mmap_mode='r')
+        self.identity = np.load(shard_dir + '/identity.npy')
+        with open(shard_dir + '/names.txt', 'r') as f:
+            self.names = [line.rstrip('\n').encode('utf-8') for line in f]
+        self.num = self.photo.shape[0]
+        self.img_size = self.photo.shape[1]
+        assert self.photo.shape[:3] == self.sketch.shape[:3], 'shard: photo/sketch shape mismatch'
+        assert self.num == len(self.identity) == len(self.names), 'shard: index size mismatch'
+
+    def windows(self, padding_size, crop_size, random_crop, rng):
+        # crop window (y, x) in padded-image coordinates, same convention as preprocess()
+        size = self.img_size
+        if (padding_size != None) and (padding_size != False):
+            size = padding_size
+        if (crop_size == None) or (crop_size == False):
+            crop_size = size
+        if random_crop:
+            return rng.randint(0, size - crop_size + 1), rng.randint(0, size - crop_size + 1), size, crop_size
+        return (size - crop_size) // 2, (size - crop_size) // 2, size, crop_size
+
+    def copy_crop(self, out, src, top, left, padded_size, crop_size, flip):
+        # copy the part of the crop window that overlaps the (virtually padded) image straight from the mmap view
+        # returns the copied window (y0, y1, x0, x1) in out coordinates, the rest of out is padding
+        pad = (padded_size - self.img_size) // 2
+        y0 = max(top - pad, 0)
+        y1 = min(top - pad + crop_size, self.img_size)
+        x0 = max(left - pad, 0)
+        x1 = min(left - pad + crop_size, self.img_size)
+        if (y0 >= y1) or (x0 >= x1):
+            return 0, 0, 0, 0
+        dy0 = y0 - (top - pad)
+        dx0 = x0 - (left - pad)
+        view = src[y0:y1, x0:x1]
+        if flip:
+            dx0 = crop_size - dx0 - (x1 - x0)
+            out[dy0:dy0 + (y1 - y0), dx0:dx0 + (x1 - x0)] = view[:, ::-1]
+        else:
+            out[dy0:dy0 + (y1 - y0), dx0:dx0 + (x1 - x0)] = view
+        return dy0, dy0 + (y1 - y0), dx0, dx0 + (x1 - x0)
+
+    def samples(self, padding_size, crop_size, random_crop, flip, shuffle, rng):
+        # endless stream of (index, crop top, crop left, flip)
+        order = np.arange(self.num)
+        pos = self.num
+        while True:
+            if pos == self.num:
+                if shuffle:
+                    rng.shuffle(order)
+                pos = 0
+            k = order[pos]
+            pos += 1
+            top, left, _, _ = self.windows(padding_size, crop_size, random_crop, rng)
+            do_flip = flip and (rng.rand() < 0.5)
+            yield k, top, left, do_flip
+
+    def batches(self, batch_size, padding_size=None, crop_size=None, random_crop=False, flip=False, shuffle=False,
+                seed=None, skip_batches=0):
+        # endless generator of uint8 batches, the only copy is into the batch buffers
+        # window: int32 [batch_size, 4] copied window (y0, y1, x0, x1) of each sample, outside of it is padding
+        # skip_batches: advance the sample stream without copying (resume)
+        rng = np.random.RandomState(seed)
+        _, _, padded_size, out_size = self.windows(padding_size, crop_size, False, rng)
+        samples = self.samples(padding_size, crop_size, random_crop, flip, shuffle, rng)
+        for _ in range(skip_batches * batch_size):
+            next(samples)
+        while True:
+            photo = np.zeros([batch_size, out_size, out_size, self.photo.shape[3]], dtype=np.uint8)
+            sketch = np.zeros([batch_size, out_size, out_size, self.sketch.shape[3]], dtype=np.uint8)
+            identity = np.zeros([batch_size], dtype=np.int32)
+            window = np.zeros([batch_size, 4], dtype=np.int32)
+            names = []
+            for b in range(batch_size):
+                k, top, left, do_flip = next(samples)
+                window[b] = self.copy_crop(photo[b], self.photo[k], top, left, padded_size, out_size, do_flip)
+                self.copy_crop(sketch[b], self.sketch[k], top, left, padded_size, out_size, do_flip)
+                identity[b] = self.identity[k]
+                names.append(self.names[k])
+            yield photo, sketch, identity, np.array(names), window
+
+
+def normalize_padded(images, window):
+    # uint8 [B, S, S, C] -> [-1, 1], pixels outside window (y0, y1, x0, x1) are 0,
+    # the value preprocess() pads with (it pads after normalization)
+    image = tf.divide(tf.subtract(tf.to_float(images), 127.5), 127.5)
+    pos = tf.range(tf.shape(images)[1])[None, :]
+    rows = tf.logical_and(pos >= window[:, 0:1], pos < window[:, 1:2])
+    cols = tf.logical_and(pos >= window[:, 2:3], pos < window[:, 3:4])
+    mask = tf.logical_and(rows[:, :, None], cols[:, None, :])
+    return image * tf.to_float(mask)[:, :, :, None]
+
+
+def photo_sketch_batch_shard(input_dir, photo_txt, sketch_txt, num_identity, num_style, style_list, batch_size,
+                             img_size=256, name='', photo_dim=3, sketch_dim=3, flip=False, crop_size=None,
+                             padding_size=None, random_crop=False, train_mode='train_gan', concat_sketch_styles=False,
+                             log_dir=None, prefetch_size=2, seed=None, shard_dir=None, skip_batches=0):
+    # drop-in for photo_sketch_batch_inputs (same returns), reads a shard written by pack_shard.py
+    # no decode: crops are copied from the mmap straight into the batch
+    with tf.device('/cpu:0'):
+        assert (num_style == 1) and (len(style_list) == 1), 'input_data: shard supports one sketch style'
+        if train_mode == 'test_gan':
+            shuffle = False
+            flip = False
+            random_crop = False
+        elif train_mode == 'train_gan':
+            shuffle = True
+        else:
+            assert False, 'input_data: train_mode Error'
+        if seed == None:
+            seed = random.randint(0, 2**31 - 1)
+        if shard_dir == None:
+            shard_dir = shard_path(input_dir, photo_txt, style_list[0])
+        print(shard_dir)
+
+        shard = PhotoSketchShard(shard_dir)
+        assert shard.img_size == img_size, 'input_data: shard image size error'
+        assert (shard.photo.shape[3] == photo_dim) and (shard.sketch.shape[3] == sketch_dim), 'input_data: shard channel error'
+        photo_num = shard.num
+        sketch_num = shard.num
+        print('number of photo: %d' % photo_num)
+        print('number of sketch: %d' % sketch_num)
+        if log_dir != None:
+            write_input_log(log_dir, [n.decode('utf-8') for n in shard.names], photo_num)
+
+        _, _, _, out_size = shard.windows(padding_size, crop_size, False, None)
+        generator = lambda: shard.batches(batch_size, padding_size, crop_size, random_crop, flip, shuffle, seed,
+                                          skip_batches)
+        with tf.name_scope(name+'shard'):
+            dataset = tf.data.Dataset.from_generator(
+                generator, (tf.uint8, tf.uint8, tf.int32, tf.string, tf.int32),
+                ([batch_size, out_size, out_size, photo_dim], [batch_size, out_size, out_size, sketch_dim],
+                 [batch_size], [batch_size], [batch_size, 4]))
+            dataset = dataset.map(lambda photo, sketch, identity, names, window:
+                                  (normalize_padded(photo, window), normalize_padded(sketch, window), identity,
+                                   names))
+            if prefetch_size > 0:
+                dataset = dataset.prefetch(prefetch_size)
+            photo_batch, sketch_batch, identity_batch, name_batch = dataset.make_one_shot_iterator().get_next()
+
+        return photo_batch, sketch_batch, identity_batch, identity_batch, name_batch, name_batch, photo_num, sketch_num
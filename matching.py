@@ -0,0 +1,129 @@
+# Identity matching on the intermediate domain: sketch queries against a photo gallery
+# features are grid-pooled content codes (content_s2p for sketches, content_p2s / gallery_feature for photos),
+# L2-normalized rows of one contiguous float32 matrix; cosine similarity = blocked matrix multiply
+#   python test_with_gan.py --log_dir record/step0 --use_gallery True --gall_list list_gallery_1500.txt
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+import model
+import options
+import gan_share
+import checkpoint
+from search import normalize_rows, topk_blocked
+
+RANKS = [1, 5, 10, 20]
+
+
+def rank_accuracy(indices, gallery_labels, query_labels, ranks=RANKS):
+    # {rank: fraction of queries whose identity is among the first rank retrieved gallery entries}
+    hits = np.asarray(gallery_labels)[indices] == np.asarray(query_labels)[:, None]
+    first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1), indices.shape[1])
+    return {r: float(np.mean(first_hit < r)) for r in ranks if r <= indices.shape[1]}
+
+
+class FeatureMatrix(object):
+    # growable contiguous float32 [N, D] matrix of normalized rows, with identities and names per row
+    def __init__(self, dim, capacity=1024):
+        self.matrix = np.empty([capacity, dim], dtype=np.float32)
+        self.labels = np.empty([capacity], dtype=np.int64)
+        self.names = []
+        self.size = 0
+
+    def add(self, features, labels, names=None):
+        num = len(features)
+        if self.size + num > len(self.matrix):
+            capacity = max(2 * len(self.matrix), self.size + num)
+            matrix = np.empty([capacity, self.matrix.shape[1]], dtype=np.float32)
+            matrix[0:self.size] = self.matrix[0:self.size]
+            grown_labels = np.empty([capacity], dtype=np.int64)
+            grown_labels[0:self.size] = self.labels[0:self.size]
+            self.matrix, self.labels = matrix, grown_labels
+        self.matrix[self.size:self.size + num] = normalize_rows(features)
+        self.labels[self.size:self.size + num] = labels
+        self.names += list(names) if names is not None else [''] * num
+        self.size += num
+
+    def features(self):
+        return self.matrix[0:self.size]
+
+    def search(self, queries, k=20, **kwargs):
+        return topk_blocked(queries, self.features(), k, **kwargs)
+
+
+class matchnet(object):
+    # test_with_gan.py: sketch -> photo identification with the GAN's intermediate-domain features
+    def __init__(self, config):
+        self.gpu_num = config.gpu_num
+        self.log_dir = config.log_dir
+        self.ts_min_epoch = config.ts_min_epoch
+        self.ts_max_epoch = config.ts_max_epoch
+        self.ts_unit_epoch = config.ts_unit_epoch
+        self.use_gallery = config.use_gallery
+        self.gall_txt = config.ts_dir + '/' + config.gall_list
+        self.ranks = RANKS
+
+    def build_inference(self, mode='test_with_gan', gan_config=None):
+        # GAN test graph (+ gallery input) and the pooled content codes of its photos and sketches
+        assert mode == 'test_with_gan', 'matchnet: wrong mode'
+        defaults = options.default_config()
+        gan_config = options.default_config(**dict((key, value) for key, value in vars(gan_config).items()
+                                                   if hasattr(defaults, key)))
+        gan_config.use_enc_dec = True  # content codes come from the encoder/decoder generator
+        net = gan_share.GAN(gan_config)
+        net.build_inference(mode='test_gan', test_gallery=self.use_gallery, gallery_txt=self.gall_txt)
+        net.photo_feature = model.grid_pool(net.content_p2s, net.gallery_grid)
+        net.sketch_feature = model.grid_pool(net.content_s2p, net.gallery_grid)
+        return net
+
+    def encode_test_set(self, sess, net):
+        # pooled content codes of the test photos and sketches, one pass over the test list
+        fetches = {'photo': net.photo_feature, 'sketch': net.sketch_feature, 'photo_id': net.photo_identity,
+                   'sketch_id': net.sketch_identity, 'photo_name': net.photo_name, 'sketch_name': net.sketch_name}
+        results = []
+        for _ in range(int(np.ceil(net.photo_num / float(net.ts_batch_size)))):
+            results.append(sess.run(fetches, feed_dict={net.train_mode: False}))
+        # the input cycles over the list: any photo_num consecutive elements cover it exactly once
+        num = net.photo_num
+        return dict((key, np.concatenate([r[key] for r in results])[0:num]) for key in fetches)
+
+    def evaluate(self, sess, net, ckpt_path):
+        test = self.encode_test_set(sess, net)
+        gallery = FeatureMatrix(test['photo'].shape[1], capacity=len(test['photo']))
+        gallery.add(test['photo'], test['photo_id'], test['photo_name'])
+        if self.use_gallery:
+            # extra gallery photos (identities outside the test set), cached per checkpoint
+            features, identities, names = net.gallery_features(sess, ckpt_path, self.gall_txt)
+            gallery.add(features, identities, names)
+        start_time = time.time()
+        indices, _ = gallery.search(test['sketch'], k=max(self.ranks))
+        search_time = time.time() - start_time
+        accuracy = rank_accuracy(indices, gallery.labels[0:gallery.size], test['sketch_id'], self.ranks)
+        return accuracy, gallery.size, len(test['sketch']), search_time
+
+    def test(self, net):
+        ckpt_dir = net.log_dir + '/gan_ckpt'
+        txtfile = open(self.log_dir + '/matching_log.txt', 'w')
+        print("epoch\tgallery\tqueries\t" + "\t".join('rank%d' % r for r in self.ranks) + "\tsearch_ms", file=txtfile)
+        saver = tf.train.Saver()
+        with tf.Session(config=net.session_config()) as sess:
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+            for epoch in range(self.ts_min_epoch, self.ts_max_epoch + 1, self.ts_unit_epoch):
+                _, ckpt_path = checkpoint.resolve(ckpt_dir, epoch, 'gan')
+                if not os.path.exists(ckpt_path + '.index'):
+                    print('matchnet: no checkpoint %s' % ckpt_path)
+                    continue
+                saver.restore(sess, ckpt_path)
+                accuracy, gallery_size, num_queries, search_time = self.evaluate(sess, net, ckpt_path)
+                print('epoch %d: %d queries, gallery %d, %s, search %.1f ms'
+                      % (epoch, num_queries, gallery_size,
+                         ', '.join('rank-%d %.4f' % (r, accuracy[r]) for r in sorted(accuracy)), 1000 * search_time))
+                print("%d\t%d\t%d\t" % (epoch, gallery_size, num_queries)
+                      + "\t".join('%.4f' % accuracy.get(r, float('nan')) for r in self.ranks)
+                      + "\t%.1f" % (1000 * search_time), file=txtfile)
+                txtfile.flush()
+            coord.request_stop()
+            coord.join(threads)
+        txtfile.close()
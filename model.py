@@ -124,6 +124,23 @@ def build_layer(x, layer_spec, name, train_mode=True, reuse=False):
         return rectified
 
 
+# residual layers rebuilt in the backward pass when config['recompute'] is set
+RECOMPUTE_LAYERS = ['res', 'Res', 'res_block', 'res_b', 'Res_b', 'res_bottleneck']
+
+
+def recompute_layer(x, layer_spec, name, train_mode=True, reuse=False):
+    # build_layer that keeps only its input for backprop, the activations inside are recomputed from it
+    # (tf.contrib.layers.recompute_grad needs resource variables)
+    # batch statistic updates would run again in the backward pass, so only per-sample norms are allowed
+    assert 'batch' not in str(layer_spec['norm']), 'recompute_layer: batch statistics norm %s' % layer_spec['norm']
+    layer_spec = dict(layer_spec)
+
+    def block(inputs):
+        return build_layer(inputs, layer_spec, name=name, train_mode=train_mode, reuse=reuse)
+    with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+        return tf.contrib.layers.recompute_grad(block)(x)
+
+
 def CNN_Encoder(inputs, config, train_mode=True, name="ENC_", reuse=False, share=None, share_name="ENC",
                 share_reuse=False):
     layers = []
@@ -164,7 +181,10 @@ def CNN_Encoder(inputs, config, train_mode=True, name="ENC_", reuse=False, share
                 layer_spec['rectifier'] = config['output_activation']
 
         # build a layer
-        layers.append(build_layer(layers[-1], layer_spec, name=layer_name, train_mode=train_mode, reuse=reuse))
+        if config.get('recompute', False) and (layer_type in RECOMPUTE_LAYERS):
+            layers.append(recompute_layer(layers[-1], layer_spec, name=layer_name, train_mode=train_mode, reuse=reuse))
+        else:
+            layers.append(build_layer(layers[-1], layer_spec, name=layer_name, train_mode=train_mode, reuse=reuse))
 
         i += 1
 
@@ -416,6 +436,30 @@ def AdaIN(content, style, epsilon=1e-5):
     
     return (content - meanC) * sigmaS / sigmaC + meanS
 
+def grid_pool(features, grid=4):
+    # average of each cell of a grid x grid partition, flattened: [N, H, W, C] -> [N, grid * grid * C]
+    shape = features.get_shape().as_list()
+    ksize = [1, shape[1] // grid, shape[2] // grid, 1]
+    pooled = tf.nn.avg_pool(features, ksize, ksize, padding='VALID')
+    return tf.reshape(pooled, [-1, grid * grid * shape[3]])
+
+def instance_content(features, epsilon=1e-5):
+    # per-instance normalized features, the content part of AdaIN (content_p2s / content_s2p)
+    mean, var = tf.nn.moments(features, [1, 2], keep_dims=True)
+    return (features - mean) / tf.sqrt(tf.add(var, epsilon))
+
+def style_statistics(style, epsilon=1e-5):
+    # AdaIN target statistics of the style features, (mean, sigma) [N, 1, 1, C]
+    meanS, varS = tf.nn.moments(style, [1, 2], keep_dims=True)
+    return meanS, tf.sqrt(tf.add(varS, epsilon))
+
+def AdaIN_statistics(content, meanS, sigmaS, epsilon=1e-5):
+    # AdaIN with given style statistics (style_statistics), same result as AdaIN(content, style)
+    meanC, varC = tf.nn.moments(content, [1, 2], keep_dims=True)
+    sigmaC = tf.sqrt(tf.add(varC, epsilon))
+
+    return (content - meanC) * sigmaS / sigmaC + meanS
+
 def AdaIN_update(content, style, epsilon=1e-5):
     meanC, varC = tf.nn.moments(content, [1, 2], keep_dims=True)
     meanS, varS = tf.nn.moments(style,   [1, 2], keep_dims=True)
@@ -473,10 +517,56 @@ def AdaIN_p2s_s2p_new(content, style, epsilon=1e-5):
 
     gen_med_p2s1 = content
     gen_med_s2p1 = style
-    
+
     return gen_med_p2s, gen_med_p2s1, C_p2s, gen_med_s2p, gen_med_s2p1, C_s2p
 
 
+def adain_moments(content, style, epsilon=1e-5):
+    # mean and sigma of content and style in one pass over the stacked features (E[x], E[x^2])
+    features = tf.stack([content, style])
+    mean = tf.reduce_mean(features, [2, 3], keepdims=True)
+    mean_sq = tf.reduce_mean(tf.square(features), [2, 3], keepdims=True)
+    sigma = tf.sqrt(tf.maximum(mean_sq - tf.square(mean), 0.) + epsilon)
+    return mean[0], sigma[0], mean[1], sigma[1]
+
+
+def AdaIN_fused(content, style, epsilon=1e-5):
+    # AdaIN_p2s_s2p_new with single-pass moments and an analytic backward pass
+    # only content, style and the moments are kept for the backward pass, the normalized maps are recomputed
+    @tf.custom_gradient
+    def adain(content, style):
+        meanC, sigmaC, meanS, sigmaS = adain_moments(content, style, epsilon)
+        C_p2s = (content - meanC) / sigmaC
+        C_s2p = (style - meanS) / sigmaS
+        gen_med_p2s = C_p2s * sigmaS + meanS
+        gen_med_s2p = C_s2p * sigmaC + meanC
+
+        def grad(d_p2s, d_C_p2s, d_s2p, d_C_s2p):
+            # each input: normalized map gradient, plus its mean/sigma restyling the other direction
+            size = tf.cast(tf.shape(content)[1] * tf.shape(content)[2], content.dtype)
+
+            def normalize_grad(x, mean, sigma, d_norm, d_mean, d_sigma):
+                x_norm = (x - mean) / sigma
+                d_x = (d_norm - tf.reduce_mean(d_norm, [1, 2], keepdims=True)
+                       - x_norm * tf.reduce_mean(d_norm * x_norm, [1, 2], keepdims=True)) / sigma
+                return d_x + (d_mean + d_sigma * x_norm) / size
+
+            C_p2s = (content - meanC) / sigmaC
+            C_s2p = (style - meanS) / sigmaS
+            d_content = normalize_grad(content, meanC, sigmaC, d_C_p2s + d_p2s * sigmaS,
+                                       tf.reduce_sum(d_s2p, [1, 2], keepdims=True),
+                                       tf.reduce_sum(d_s2p * C_s2p, [1, 2], keepdims=True))
+            d_style = normalize_grad(style, meanS, sigmaS, d_C_s2p + d_s2p * sigmaC,
+                                     tf.reduce_sum(d_p2s, [1, 2], keepdims=True),
+                                     tf.reduce_sum(d_p2s * C_p2s, [1, 2], keepdims=True))
+            return d_content, d_style
+
+        return (gen_med_p2s, C_p2s, gen_med_s2p, C_s2p), grad
+
+    gen_med_p2s, C_p2s, gen_med_s2p, C_s2p = adain(content, style)
+    return gen_med_p2s, content, C_p2s, gen_med_s2p, style, C_s2p
+
+
 def AdaIN_p2s_s2p_concat(content, style, epsilon=1e-5):
     meanC, varC = tf.nn.moments(content, [1, 2], keep_dims=True)
     meanS, varS = tf.nn.moments(style,   [1, 2], keep_dims=True)
@@ -0,0 +1,107 @@
+# Command line options of the GAN trainer (train_step_by_step_share.py), also used by the benchmark/export tools
+import argparse
+
+
+def str2bool(value):
+    # type=bool would read any non-empty string, 'False' included, as True
+    if value.lower() in ('true', 't', 'yes', 'y', '1'):
+        return True
+    if value.lower() in ('false', 'f', 'no', 'n', '0'):
+        return False
+    raise argparse.ArgumentTypeError('boolean value expected, got %s' % value)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    # training
+    parser.add_argument('--gpu_num', type=int, default=0)
+    parser.add_argument('--log_dir', type=str, default='record')
+    parser.add_argument('--load_dir', type=str, default='record')
+    parser.add_argument('--continue_tr', type=bool, default=False)
+    parser.add_argument('--load_epoch', type=int, default=2300) # -1: latest checkpoint
+    parser.add_argument('--max_epoch', type=int, default=5000)
+    parser.add_argument('--similarity_loss', type=str, default='L1')
+    parser.add_argument('--similarity_lambda', type=float, default=10)
+    parser.add_argument('--similarity_loss_med', type=str, default='L1')
+    parser.add_argument('--med_lambda', type=float, default=1)
+    parser.add_argument('--med_step', type=int, default=0)
+    # inputs
+    parser.add_argument('--img_size', type=int, default=272)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--accum_steps', type=int, default=1) # micro-batches per update (batch_size / accum_steps each)
+    parser.add_argument('--update_schedule', type=str, default='fused') # fused (d+g in one run), alternate
+    parser.add_argument('--n_critic', type=int, default=1) # discriminator updates per generator update
+    parser.add_argument('--tr_dir', type=str, default="../data/synthesis/DB272prip")
+    parser.add_argument('--ts_dir', type=str, default="../data/synthesis/DB272prip")
+    parser.add_argument('--tr_list', type=str, default='tr_list.txt')
+    parser.add_argument('--ts_list', type=str, default='ts_list.txt')
+    parser.add_argument('--num_identity', type=int, default=48)
+    parser.add_argument('--input_engine', type=str, default='queue') # queue, dataset, shard (pack_shard.py)
+    parser.add_argument('--input_threads', type=int, default=4)
+    parser.add_argument('--prefetch_size', type=int, default=2)
+    parser.add_argument('--input_seed', type=int, default=-1) # -1: random
+    parser.add_argument('--input_bench_steps', type=int, default=0)
+    parser.add_argument('--batch_augment', type=str2bool, default=False)
+    # network
+    parser.add_argument('--g_model', type=str, default='col_gen')
+    parser.add_argument('--d_model', type=str, default='PatchGan')
+    #201005
+    parser.add_argument('--use_enc_dec', type=bool, default=True)
+    parser.add_argument('--g_enc_model', type=str, default='col_gen_enc') # col_gen_enc, col_gen_short
+    parser.add_argument('--g_dec_model', type=str, default='col_gen_dec') # col_gen_dec, col_gen_short
+    parser.add_argument('--med_channels', type=int, default=256)
+    parser.add_argument('--fuse_passes', type=str2bool, default=False) # one decoder/discriminator pass per shared weight set (per-sample norms only)
+    parser.add_argument('--norm_g', type=str, default='batch_instance') # generator norm: batch_instance, instance, batch
+    parser.add_argument('--norm_d', type=str, default='batch_instance') # discriminator norm
+    parser.add_argument('--mixed_precision', type=str, default='none') # none, fp16
+    parser.add_argument('--recompute', type=str2bool, default=False) # recompute residual blocks in the backward pass (per-sample norms only)
+    parser.add_argument('--fused_adain', type=str2bool, default=False) # model.AdaIN_fused: single-pass moments, analytic backward
+    parser.add_argument('--num_replicas', type=int, default=1) # data parallel towers, batch_size is split between them
+    parser.add_argument('--replica_device', type=str, default='gpu') # gpu, cpu (virtual cpu devices)
+    #matching
+    parser.add_argument('--enc_model', type=str, default='alex')
+    parser.add_argument('--enc_norm', type=str, default='batch')
+    parser.add_argument('--g_matching_lambda', type=float, default=1)
+    #learning rate
+    parser.add_argument('--enc_lr', type=float, default=0.0002)
+    parser.add_argument('--g_lr', type=float, default=0.0002)
+    parser.add_argument('--d_lr', type=float, default=0.0002)
+    #record
+    parser.add_argument('--print_epoch', type=int, default=10)
+    parser.add_argument('--save_epoch', type=int, default=100)
+    parser.add_argument('--summary_mode', type=str, default='fused') # fused, scalar, separate (extra run), none
+    parser.add_argument('--ckpt_async', type=str2bool, default=False) # write checkpoints on a background thread
+    parser.add_argument('--ckpt_keep_last', type=int, default=0) # checkpoints kept, 0: all
+    parser.add_argument('--ckpt_keep_best', type=int, default=1) # with ckpt_keep_last, also keep the best by test SSIM
+    parser.add_argument('--writer_threads', type=int, default=2) # 0: write images in the training loop
+    parser.add_argument('--writer_queue', type=int, default=16)
+    parser.add_argument('--profile_trace_every', type=int, default=0) # step trace/timeline every N steps (gan_profile/), 0: off
+    #test
+    parser.add_argument('--ts_batch_size', type=int, default=5)
+    parser.add_argument('--ts_display_batches', type=int, default=-1) # test batches saved as images, -1: all
+    parser.add_argument('--ts_min_epoch', type=int, default=100)
+    parser.add_argument('--ts_max_epoch', type=int, default=5000)
+    parser.add_argument('--ts_unit_epoch', type=int, default=100)
+    parser.add_argument('--use_gallery', type=bool, default=False)
+    parser.add_argument('--gallery_grid', type=int, default=4) # gallery features: gallery_med average pooled on a grid
+    parser.add_argument('--gallery_cache_dir', type=str, default='') # '' for <log_dir>/gallery_cache
+    parser.add_argument('--gall_list', type=str, default='list_gallery_1500.txt')
+    #train mode
+    #parser.add_argument('--train_mode', type=str, default='train_with_gan') #original
+    #--------------
+    parser.add_argument('--train_mode', type=str, default='train_gan')
+    #d_meds
+    parser.add_argument('--d_p2s', type=str, default='False')
+    parser.add_argument('--d_s2p', type=str, default='False')
+    parser.add_argument('--med_d_lambda', type=float, default=0.1)
+
+    return parser
+
+
+def default_config(**overrides):
+    # parsed defaults, for tools that build a GAN without a command line
+    config = build_parser().parse_args([])
+    for key in overrides:
+        assert hasattr(config, key), 'options: unknown option %s' % key
+        setattr(config, key, overrides[key])
+    return config
@@ -0,0 +1,53 @@
+# Pack a photo/sketch list into a pre-decoded, memory-mapped shard for input_data.photo_sketch_batch_shard
+import os
+import argparse
+import numpy as np
+
+import input_data
+from utils import read_image
+
+
+def pack_shard(input_dir, list_txt, style, out_dir, img_size=272, photo_dim=3, sketch_dim=3):
+    photo_filedirs, filenames, identities = input_data.read_dirs_with_txt([input_dir+'/photo'], list_txt, 0)
+    sketch_filedirs, _, _ = input_data.read_dirs_with_txt([input_dir+'/'+style], list_txt, 0)
+    num = len(photo_filedirs)
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    photo = np.lib.format.open_memmap(out_dir + '/photo.npy', mode='w+', dtype=np.uint8,
+                                      shape=(num, img_size, img_size, photo_dim))
+    sketch = np.lib.format.open_memmap(out_dir + '/sketch.npy', mode='w+', dtype=np.uint8,
+                                       shape=(num, img_size, img_size, sketch_dim))
+    for i in range(num):
+        photo[i] = read_image(photo_filedirs[i], img_size, photo_dim)
+        sketch[i] = read_image(sketch_filedirs[i], img_size, sketch_dim)
+        if (i + 1) % 500 == 0:
+            print('packed %d/%d' % (i + 1, num))
+    photo.flush()
+    sketch.flush()
+    del photo, sketch
+
+    np.save(out_dir + '/identity.npy', np.array(identities, dtype=np.int32))
+    with open(out_dir + '/names.txt', 'w') as f:
+        for filename in filenames:
+            print(filename, file=f)
+    print('%d pairs -> %s' % (num, out_dir))
+    return num
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tr_dir', type=str, default="../data/synthesis/DB272prip")
+    parser.add_argument('--tr_list', type=str, default='tr_list.txt')
+    parser.add_argument('--style', type=str, default='real_db')
+    parser.add_argument('--out_dir', type=str, default=None)  # default: input_data.shard_path()
+    parser.add_argument('--img_size', type=int, default=272)
+    parser.add_argument('--photo_dim', type=int, default=3)
+    parser.add_argument('--sketch_dim', type=int, default=3)
+    config = parser.parse_args()
+
+    list_txt = config.tr_dir + '/' + config.tr_list
+    out_dir = config.out_dir
+    if out_dir is None:
+        out_dir = input_data.shard_path(config.tr_dir, list_txt, config.style)
+    pack_shard(config.tr_dir, list_txt, config.style, out_dir, config.img_size, config.photo_dim, config.sketch_dim)
@@ -0,0 +1,31 @@
+# Mixed precision: fp16 compute with fp32 master weights and dynamic loss scaling
+# (bfloat16 is left out until the ops.py helpers have been run with it)
+import tensorflow as tf
+
+COMPUTE_DTYPES = {'fp16': tf.float16}
+
+
+def compute_dtype(mode):
+    assert mode in COMPUTE_DTYPES, 'precision: wrong mixed precision mode %s' % mode
+    return COMPUTE_DTYPES[mode]
+
+
+def float32_variable_getter(dtype):
+    # custom_getter: trainable float variables are stored (and updated by the optimizers) in fp32
+    # and read through a cast to the compute dtype; non-trainable variables (norm statistics) are created
+    # with the dtype their helper requests
+    def float32_getter(getter, *args, **kwargs):
+        requested = kwargs.get('dtype')
+        if (kwargs.get('trainable') is not False) and (requested in (None, tf.float32, dtype)):
+            kwargs['dtype'] = tf.float32
+            return tf.cast(getter(*args, **kwargs), dtype)
+        return getter(*args, **kwargs)
+    return float32_getter
+
+
+def loss_scale_optimizer(optimizer, mode, init_loss_scale=2**15, incr_every_n_steps=2000):
+    # fp16 needs loss scaling; returns (optimizer, loss scale tensor)
+    if mode != 'fp16':
+        return optimizer, tf.constant(1.0)
+    manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(init_loss_scale, incr_every_n_steps)
+    return tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, manager), manager.get_loss_scale()
@@ -0,0 +1,117 @@
+# Training loop instrumentation: wall time per phase, queue fill levels, scheduled step traces
+# one row per epoch in <log_dir>/gan_profile.txt, chrome timelines (chrome://tracing) in <log_dir>/gan_profile/
+import os
+import time
+import contextlib
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+PHASES = ['train', 'summary', 'test', 'images', 'checkpoint']
+# trace categories, first match wins (node names of GAN.build_network/build_optimizer)
+TRACE_CATEGORIES = [('optimizer', ['Adam', 'accum']),
+                    ('gen_backward', ['gradients*Gen_']),
+                    ('dis_backward', ['gradients*Dis_']),
+                    ('backward', ['gradients']),
+                    ('input', ['IteratorGetNext', 'QueueDequeue', 'tr_inp', 'ts_inp']),
+                    ('gen_forward', ['Gen_']),
+                    ('dis_forward', ['Dis_'])]
+
+
+def trace_category(node_name):
+    for category, patterns in TRACE_CATEGORIES:
+        for pattern in patterns:
+            parts = pattern.split('*')
+            pos = 0
+            for part in parts:
+                pos = node_name.find(part, pos)
+                if pos < 0:
+                    break
+                pos += len(part)
+            if pos >= 0:
+                return category
+    return 'other'
+
+
+def trace_breakdown(run_metadata):
+    # op time (ms) per category, summed over devices; ops overlap, so the sum can exceed the step time
+    times = {}
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            category = trace_category(node_stats.node_name)
+            times[category] = times.get(category, 0.0) + node_stats.all_end_rel_micros / 1000.0
+    return times
+
+
+class StepProfiler(object):
+    def __init__(self, log_dir, trace_every=0, name='gan_profile'):
+        self.trace_every = trace_every  # trace one training step every N steps (0: off)
+        self.trace_dir = log_dir + '/' + name
+        if (trace_every > 0) and (not os.path.exists(self.trace_dir)):
+            os.mkdir(self.trace_dir)
+        # queue runner queues (queue engine), their sizes are fetched with the training step
+        queues = [qr.queue for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)]
+        self.queue_names = [q.name for q in queues]
+        self.queue_sizes = [q.size() for q in queues]
+        self.txtfile = open(log_dir + '/' + name + '.txt', 'w')
+        print("epoch\tsteps\tstep_ms\t" + "\t".join(p + '_ms' for p in PHASES) + "\tother_ms\tqueue_fill\ttrace",
+              file=self.txtfile)
+        self.reset()
+
+    def reset(self):
+        self.times = dict((p, 0.0) for p in PHASES)
+        self.queue_samples = []
+        self.traces = []
+        self.steps = 0
+        self.epoch_start = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        yield
+        self.times[name] += time.time() - start_time
+
+    def step_fetches(self):
+        return {'queue_sizes': self.queue_sizes} if self.queue_sizes else {}
+
+    def run_options(self, step):
+        # (options, run_metadata) for sess.run, both None when this step is not traced
+        if (self.trace_every > 0) and (step % self.trace_every == 0):
+            return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+        return None, None
+
+    def end_step(self, step, result=None, run_metadata=None):
+        self.steps += 1
+        if (result is not None) and ('queue_sizes' in result):
+            self.queue_samples.append(result['queue_sizes'])
+        if run_metadata is not None:
+            self.traces.append(trace_breakdown(run_metadata))
+            trace = timeline.Timeline(run_metadata.step_stats)
+            with open(self.trace_dir + '/timeline_step_%d.json' % step, 'w') as f:
+                f.write(trace.generate_chrome_trace_format())
+
+    def report(self, epoch):
+        # one row: mean ms per training step of each phase, mean queue sizes, mean trace breakdown
+        if self.steps == 0:
+            return
+        total = time.time() - self.epoch_start
+        row = [str(epoch), str(self.steps), '%.1f' % (1000 * total / self.steps)]
+        row += ['%.1f' % (1000 * self.times[p] / self.steps) for p in PHASES]
+        row.append('%.1f' % (1000 * (total - sum(self.times.values())) / self.steps))
+        if self.queue_samples:
+            fill = np.mean(np.array(self.queue_samples, dtype=np.float64), axis=0)
+            row.append(','.join('%s=%.1f' % (n, f) for n, f in zip(self.queue_names, fill)))
+        else:
+            row.append('-')
+        if self.traces:
+            categories = sorted(set(c for trace in self.traces for c in trace))
+            row.append(','.join('%s=%.1f' % (c, np.mean([trace.get(c, 0.0) for trace in self.traces]))
+                                for c in categories))
+        else:
+            row.append('-')
+        print("\t".join(row), file=self.txtfile)
+        self.txtfile.flush()
+        self.reset()
+
+    def close(self):
+        self.txtfile.close()
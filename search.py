@@ -0,0 +1,41 @@
+# Exact cosine-similarity search over L2-normalized float32 rows, NumPy only (no TensorFlow import)
+# shared by matching.py (sketch -> photo identification) and ann.py (exact baseline of the ANN index)
+import numpy as np
+
+
+def normalize_rows(features, eps=1e-12):
+    features = np.ascontiguousarray(features, dtype=np.float32)
+    norms = np.sqrt(np.einsum('ij,ij->i', features, features))
+    return features / np.maximum(norms, eps)[:, None]
+
+
+def topk_blocked(queries, gallery, k=20, query_block=1024, gallery_block=16384, normalize_gallery=False):
+    # (indices, scores) [num_queries, k] of the k most similar gallery rows, best first
+    # memory: one query_block x (gallery_block + k) score block at a time; gallery may be a memmap
+    # (normalize_gallery: rows are normalized block by block as they are read)
+    queries = normalize_rows(queries)
+    k = min(k, len(gallery))
+    indices = np.empty([len(queries), k], dtype=np.int64)
+    scores = np.empty([len(queries), k], dtype=np.float32)
+    for q_start in range(0, len(queries), query_block):
+        query = queries[q_start:q_start + query_block]
+        best_scores = np.full([len(query), 0], -np.inf, dtype=np.float32)
+        best_indices = np.zeros([len(query), 0], dtype=np.int64)
+        for g_start in range(0, len(gallery), gallery_block):
+            block = np.asarray(gallery[g_start:g_start + gallery_block], dtype=np.float32)
+            if normalize_gallery:
+                block = normalize_rows(block)
+            block_scores = np.dot(query, block.T)
+            # merge the running top-k with this block
+            cand_scores = np.concatenate([best_scores, block_scores], axis=1)
+            cand_indices = np.concatenate([best_indices, np.broadcast_to(
+                np.arange(g_start, g_start + len(block), dtype=np.int64), block_scores.shape)], axis=1)
+            if cand_scores.shape[1] > k:
+                part = np.argpartition(-cand_scores, k - 1, axis=1)[:, 0:k]
+                cand_scores = np.take_along_axis(cand_scores, part, axis=1)
+                cand_indices = np.take_along_axis(cand_indices, part, axis=1)
+            best_scores, best_indices = cand_scores, cand_indices
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        scores[q_start:q_start + len(query)] = np.take_along_axis(best_scores, order, axis=1)
+        indices[q_start:q_start + len(query)] = np.take_along_axis(best_indices, order, axis=1)
+    return indices, scores
@@ -6,7 +6,7 @@ import argparse
 
 import matching
 #import gan_old as gan  #original is import gan
-import gan as gan  #original is import gan
+import gan_share as gan  #original is import gan
 from utils import *
 
 parser = argparse.ArgumentParser()
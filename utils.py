@@ -4,6 +4,10 @@ from skimage import io
 import html
 import tensorflow as tf
 import re
+import atexit
+import threading
+import queue
+import resource
 
 
 def save_examples(img, img_dir, name, num=None):
@@ -27,13 +31,55 @@ def save_examples(img, img_dir, name, num=None):
     return
 
 
+def result_names(result):
+    name_list = []
+    for i in range(len(result['name'])):
+        name_list.append(os.path.splitext(result['name'][i].decode('utf-8'))[0])
+    return name_list
+
+
+def read_image(filedir, img_size, channel):
+    image = io.imread(filedir)
+    if image.ndim == 2:
+        image = image[:, :, None]
+    if image.shape[2] > channel:
+        image = image[:, :, 0:channel]    # drop alpha
+    if image.shape[2] < channel:
+        image = np.repeat(image[:, :, 0:1], channel, axis=2)    # gray to rgb, like decode_image(channels=3)
+    assert image.shape == (img_size, img_size, channel), 'read_image: image size error %s' % filedir
+    return image.astype(np.uint8)
+
+
+def center_crop_or_pad(image, size):
+    # numpy version of tf.image.resize_image_with_crop_or_pad for one [H, W, C] image
+    height, width = image.shape[0], image.shape[1]
+    out = np.zeros([size, size, image.shape[2]], dtype=image.dtype)
+    y_in = max((height - size) // 2, 0)
+    x_in = max((width - size) // 2, 0)
+    y_out = max((size - height) // 2, 0)
+    x_out = max((size - width) // 2, 0)
+    h = min(height, size)
+    w = min(width, size)
+    out[y_out:y_out + h, x_out:x_out + w] = image[y_in:y_in + h, x_in:x_in + w]
+    return out
+
+
+def load_test_image(filedir, img_size, channel=3, padding_size=None, crop_size=None):
+    # file -> float32 [-1, 1] image, same as the test-mode preprocess() (pad, center crop, no flip)
+    image = read_image(filedir, img_size, channel).astype(np.float32)
+    image = (image - 127.5) / 127.5
+    if (padding_size != None) and (padding_size != False) and (padding_size != img_size):
+        image = center_crop_or_pad(image, padding_size)
+    if (crop_size != None) and (crop_size != False) and (crop_size != padding_size):
+        image = center_crop_or_pad(image, crop_size)
+    return image
+
+
 def visualize_results(log_dir, result, display_list):
     if not os.path.exists(log_dir):
         os.mkdir(log_dir)
     # img names
-    name_list = []
-    for i in range(len(result['name'])):
-        name_list.append(os.path.splitext(result['name'][i].decode('utf-8'))[0])
+    name_list = result_names(result)
     # display imgs
     for folder in display_list:
         save_examples(result[folder], log_dir + '/' + folder, name_list)
@@ -41,6 +87,65 @@ def visualize_results(log_dir, result, display_list):
     return
 
 
+class AsyncResultWriter(object):
+    # runs visualize_results on a worker pool so image encoding/writing is off the training thread
+    # the bounded queue blocks submit() when disk falls behind (backpressure), flush() waits for all
+    # pending results, and close() is registered with atexit so nothing is lost on exit
+    def __init__(self, num_workers=2, max_pending=16):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.closed = False
+        self.workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        atexit.register(self.close)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                visualize_results(*job)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, log_dir, result, display_list):
+        # result is the numpy dict from sess.run, it is not modified afterwards
+        assert not self.closed, 'AsyncResultWriter: submit after close'
+        self._check()
+        # folders are created here, so concurrent workers never race on mkdir
+        for folder in [log_dir] + [log_dir + '/' + f for f in display_list]:
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+        self.jobs.put((log_dir, result, display_list))
+
+    def flush(self):
+        self.jobs.join()
+        self._check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self._check()
+
+    def _check(self):
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+
+
 def write_html(log_dir, display_list):
     name = os.listdir(log_dir + '/' + display_list[0])
     name.sort(key=natural_keys)
@@ -65,6 +170,87 @@ def write_html(log_dir, display_list):
     return
 
 
+class HtmlReport(object):
+    # incremental replacement for write_html: rows are appended while the test loop runs, pages are
+    # split every rows_per_page rows (results.html, results_1.html, ...), and one append-only
+    # index.html in report_dir links every page of every epoch, so nothing is re-listed or rewritten
+    def __init__(self, report_dir, display_list, rows_per_page=500):
+        self.report_dir = report_dir
+        self.display_list = display_list
+        self.rows_per_page = rows_per_page
+        self.page_file = None
+        if not os.path.exists(report_dir):
+            os.mkdir(report_dir)
+        index_path = report_dir + '/index.html'
+        new_index = not os.path.exists(index_path)
+        self.index_file = open(index_path, 'a')
+        if new_index:
+            self.index_file.write('<html><body><table>')
+            self.index_file.write('<tr><th>RESULTS</th><th>IMAGES</th><th>PAGES</th></tr>\n')
+            self.index_file.flush()
+
+    def page_name(self, page):
+        if page == 0:
+            return 'results.html'
+        return 'results_%d.html' % page
+
+    def begin(self, vis_dir, title):
+        if not os.path.exists(vis_dir):
+            os.mkdir(vis_dir)
+        self.vis_dir = vis_dir
+        self.title = title
+        self.page = 0
+        self.page_rows = 0
+        self.num_rows = 0
+        self.open_page()
+
+    def open_page(self):
+        self.page_file = open(self.vis_dir + '/' + self.page_name(self.page), 'w')
+        self.page_file.write('<html><body><h3>%s (page %d)</h3>' % (html.escape(self.title), self.page + 1))
+        if self.page > 0:
+            self.page_file.write("<a href='%s'>prev</a>" % self.page_name(self.page - 1))
+        self.page_file.write('<table><tr><th>NAME</th>')
+        for folder in self.display_list:
+            self.page_file.write('<th>'+folder+'</th>')
+        self.page_file.write('</tr>\n')
+
+    def close_page(self, has_next):
+        self.page_file.write('</table>')
+        if has_next:
+            self.page_file.write("<a href='%s'>next</a>" % self.page_name(self.page + 1))
+        self.page_file.write('</body></html>')
+        self.page_file.close()
+        self.page_file = None
+
+    def add_rows(self, names):
+        # names: image names without extension, in the order visualize_results saved them
+        for name in names:
+            if self.page_rows == self.rows_per_page:
+                self.close_page(has_next=True)
+                self.page += 1
+                self.page_rows = 0
+                self.open_page()
+            self.page_file.write('<tr><td><center>%s</center></td>' % name)
+            for folder in self.display_list:
+                self.page_file.write("<td><img src='%s'></td>" % (folder + '/' + name + '.png'))
+            self.page_file.write('</tr>\n')
+            self.page_rows += 1
+            self.num_rows += 1
+        self.page_file.flush()
+
+    def end(self):
+        self.close_page(has_next=False)
+        link = os.path.relpath(self.vis_dir, self.report_dir) + '/' + self.page_name(0)
+        self.index_file.write("<tr><td><a href='%s'>%s</a></td><td>%d</td><td>%d</td></tr>\n"
+                              % (link, html.escape(self.title), self.num_rows, self.page + 1))
+        self.index_file.flush()
+
+    def close(self):
+        if self.page_file is not None:
+            self.end()
+        self.index_file.close()
+
+
 def atoi(text):
     return int(text) if text.isdigit() else text
 
@@ -78,6 +264,29 @@ def natural_keys(text):
     return [ atoi(c) for c in re.split(r'(\d+)', text) ]
 
 
+def streaming_means(tensors, scope='eval_metrics'):
+    # in-graph running mean of every scalar in tensors (dict)
+    # returns (update ops, mean values, reset op); run reset before each pass and fetch values once after it
+    update_ops = {}
+    mean_values = {}
+    with tf.variable_scope(scope):
+        for key in tensors:
+            mean_values[key], update_ops[key] = tf.metrics.mean(tensors[key], name=key)
+    metric_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope=scope)
+    reset_op = tf.variables_initializer(metric_vars, name='reset')
+    return update_ops, mean_values, reset_op
+
+
+def sample_batches(num_batches, num_samples):
+    # evenly spaced batch indices, num_samples < 0: all batches
+    if (num_samples < 0) or (num_samples >= num_batches):
+        return set(range(num_batches))
+    if num_samples == 0:
+        return set()
+    stride = num_batches / float(num_samples)
+    return set(int(k * stride) for k in range(num_samples))
+
+
 def _tf_fspecial_gauss(size, sigma):
     """Function to mimic the 'fspecial' gaussian MATLAB function
     """
@@ -150,4 +359,29 @@ def tf_ms_ssim(img1, img2, mean_metric=True, level=5):
 
     if mean_metric:
         value = tf.reduce_mean(value)
-    return value
\ No newline at end of file
+    return value
+
+def write_synthetic_db(db_dir, num_images=16, img_size=272, channel=3, styles=('photo', 'real_db'),
+                       list_names=('tr_list.txt', 'ts_list.txt'), seed=0):
+    # random png images in the trainer's directory layout (db_dir/photo, db_dir/real_db, db_dir/tr_list.txt)
+    # for benchmarks that should not depend on the real data
+    rng = np.random.RandomState(seed)
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    names = ['%05d.png' % i for i in range(num_images)]
+    for style in styles:
+        if not os.path.exists(db_dir + '/' + style):
+            os.mkdir(db_dir + '/' + style)
+        for name in names:
+            image = rng.randint(0, 256, (img_size, img_size, channel)).astype(np.uint8)
+            io.imsave(db_dir + '/' + style + '/' + name, image[:, :, 0] if channel == 1 else image)
+    for list_name in list_names:
+        with open(db_dir + '/' + list_name, 'w') as f:
+            for i in range(num_images):
+                f.write('%s %d\n' % (names[i], i))
+    return names
+
+
+def peak_rss_mb():
+    # peak resident memory of this process, ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0